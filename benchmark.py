@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+# Offline benchmarks of the client's own overhead, against the local ./mock-server.py
+# No network (nor API key) needed.
+#
+# $ ./benchmark.py
+# $ ./benchmark.py --turns 50 --history 1000 10000 100000
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import os
+import random
+import readline as rl
+import statistics
+import subprocess
+import sys
+import time
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load(name: str, file_name: str):
+    """Import a script, since the file names aren't valid module names"""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(HERE, file_name))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+cli = load('chatgpt_cli', 'chatgpt-cli.py')
+mock = load('mock_server', 'mock-server.py')
+
+
+def report(name: str, times: list, extra: str = '') -> None:
+    ms = sorted(t * 1000 for t in times)
+    p95 = ms[min(len(ms) - 1, int(len(ms) * .95))]
+    print(
+        f'{name:36s} p50 {statistics.median(ms):9.2f}  p95 {p95:9.2f}  max {ms[-1]:9.2f} ms'
+        + (f'  {extra}' if extra else '')
+    )
+
+
+def timed(fn, n: int = 1) -> list:
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def text(words: int, rand: random.Random) -> str:
+    """Synthetic prose, with some long (tab-completable) words and proper nouns"""
+    vocab = mock.WORDS + [ 'International Organization', 'United Nations', 'Ångström', 'naïveté' ]
+    return ' '.join(rand.choice(vocab) for _ in range(words))
+
+
+def bench_startup(args) -> None:
+    script = os.path.join(HERE, 'chatgpt-cli.py')
+    times = timed(lambda: subprocess.run([ sys.executable, script, '--help' ], capture_output=True), args.runs)
+    report('startup (--help)', times)
+
+
+def bench_turns(args, base_url: str) -> None:
+    """End-to-end turns, as the conversation grows"""
+    cli.messages.clear()
+    prompts = iter(range(10**9))
+    for name, stream in (('turn', False), ('turn (streamed)', True)):
+        def turn():
+            prompt = f'Question {next(prompts)}'
+            if stream:
+                for _ in cli.get_response_stream(prompt, key=cli.key, model=cli.args.model): pass
+            else:
+                cli.get_response(prompt, key=cli.key, model=cli.args.model)
+        report(name, timed(turn, args.turns), f'{len(cli.messages)} messages')
+    summary = cli.client.summary()
+    print(f"{'':36s} {summary['requests']} requests, {summary['connections']} connections")
+
+
+def bench_serialize(args) -> None:
+    rand = random.Random(0)
+    for turns in (10, 100, 1000):
+        msgs = [
+            { 'role': role, 'content': text(args.words, rand) }
+            for _ in range(turns) for role in ('user', 'assistant')
+        ]
+        body = lambda: cli.request_body(cli.request_data(msgs, model=cli.args.model))
+        size = len(body())
+        report(f'serialize ({turns} turns)', timed(body, args.runs), f'{size / 1e6:.2f} MB')
+
+
+def bench_render(args) -> None:
+    import pyperclip
+    # Measure the rendering, not the clipboard tool
+    pyperclip.copy = lambda string: None
+    import rich.console
+    cli.console = lambda: rich.console.Console(file=io.StringIO(), width=100, force_terminal=True)
+    rand = random.Random(0)
+    for words in (100, 1000, 10000):
+        string = text(words // 2, rand) + '\n\n```python\nprint("hi")\n```\n\n' + text(words // 2, rand)
+        with contextlib.redirect_stdout(io.StringIO()):
+            times = timed(lambda: cli.render(string), args.runs)
+        report(f'render ({words} words)', times)
+
+
+def bench_completer(args) -> None:
+    rand = random.Random(0)
+    for size in args.history:
+        rl.clear_history()
+        for _ in range(size):
+            rl.add_history(text(12, rand))
+        cli.completion_index = cli.CompletionIndex()
+
+        def tab(prefix):
+            # readline asks for each state, until None
+            state = 0
+            while cli.completer(prefix, state) is not None:
+                state += 1
+
+        # The first one ingests the whole history
+        report(f'completer ({size} lines, first)', timed(lambda: tab('conv')))
+        prefixes = iter([ 'con', 'res', 'tok', 'per', 'ben', 'his', 'int', 'uni' ] * args.runs)
+        report(f'completer ({size} lines)', timed(lambda: tab(next(prefixes)), args.runs))
+    rl.clear_history()
+
+
+def bench_paths(args) -> None:
+    """Tab-completion of file names, in a big directory"""
+    import tempfile
+    with tempfile.TemporaryDirectory() as dir:
+        for i in range(args.files):
+            os.mkdir(f'{dir}/dir{i}') if i % 10 == 0 else open(f'{dir}/file{i}', 'w').close()
+        # Relative, else it's completed as a /command
+        dir = os.path.relpath(dir)
+        cli.dir_cache = cli.DirCache()
+        report(f'complete path ({args.files} files, first)', timed(lambda: cli.completions(f'{dir}/file1')))
+        report(f'complete path ({args.files} files)', timed(lambda: cli.completions(f'{dir}/file1'), args.runs))
+
+
+def bench_tokenize(args) -> None:
+    string = text(200_000, random.Random(0))
+    times = timed(lambda: cli.tokenize(string), args.runs)
+    report('tokenize', times, f'{len(string) / 1e6 / statistics.median(times):.1f} MB/s')
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--turns', type=int, default=20, help="Turns of the conversation, default: %(default)s")
+parser.add_argument('--runs', type=int, default=10, help="Runs of each of the other benchmarks, default: %(default)s")
+parser.add_argument('--words', type=int, default=200, help="Size of each message, default: %(default)s")
+parser.add_argument('--files', type=int, default=10_000, help="Size of the directory to complete file names in")
+parser.add_argument('--latency', type=float, default=0.0, help="Latency of the mock server, in seconds")
+parser.add_argument(
+    '--history',
+    type=int,
+    nargs='+',
+    default=[ 1_000, 10_000, 100_000 ],
+    help="Sizes of the synthetic readline histories, default: %(default)s",
+)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    server = mock.serve(mock.parser.parse_args([ '--port', '0', '--latency', str(args.latency), '--words', str(args.words) ]))
+    base_url = f'http://127.0.0.1:{server.server_address[1]}/v1'
+    cli.args = cli.parser.parse_args([ '--base-url', base_url, '--no-store' ])
+    cli.key = 'mock'
+    cli.client = cli.Client()
+
+    bench_startup(args)
+    bench_turns(args, base_url)
+    bench_serialize(args)
+    bench_render(args)
+    bench_completer(args)
+    bench_paths(args)
+    bench_tokenize(args)
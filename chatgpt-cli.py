@@ -54,9 +54,6 @@ BACKLOG = ...
 # Consider a TUI / Text UI lib, eg:
 # https://realpython.com/contact-book-python-textual/
 
-# Consider using the streaming API ? (To get incremental output/typing, like the web version)
-# https://cookbook.openai.com/examples/how_to_stream_completions
-
 # Put this file into its own repo (so that vscode uses just one venv per workspace/repo)
 # Move this dir to its own repo
 # http://manpages.ubuntu.com/manpages/git-filter-repo
@@ -103,52 +100,105 @@ BACKLOG = ...
 
 ################################################################################
 
+# For --startup-profile: the start time, before any other imports
+import time
+START = time.perf_counter()
+
 import argparse
+import atexit
+import bisect
+import collections
+import contextlib
+import functools
+import hashlib
+import heapq
+import itertools
 import json
 import logging
+import math
+import mmap
 import os
-import pprint
+import random
+import re
 import readline as rl
 import select
+import shutil
 import subprocess
 import sys
 import textwrap
-import time
+import threading
 from typing import Optional
 
 import colorama
-import openai
-import regex
-import requests
-import rich.console
-import rich.markdown
 from colorama import Back, Fore, Style
-import pyperclip
-from unidecode import unidecode
+
+# Heavier modules are imported when (first) needed, for a faster startup.
+# Eg a one-shot question doesn't need readline completion, nor the clipboard.
+DEFERRED_IMPORTS = [
+    'requests',
+    'regex',
+    'sqlite3',
+    'unidecode',
+    'pyperclip',
+    'rich.console',
+    'rich.live',
+    'rich.markdown',
+    'tiktoken',
+    'orjson',
+]
+
+IMPORTED = time.perf_counter()
 
 
 INDENT = 0
 def width():
-    WRAP_WIDTH = os.get_terminal_size().columns
+    # Unlike os.get_terminal_size(), falls back to 80 if not a terminal (eg piped)
+    WRAP_WIDTH = shutil.get_terminal_size().columns
     WRAP_WIDTH = int(WRAP_WIDTH * .8)
     WRAP_WIDTH = min(100, WRAP_WIDTH)
     WRAP_WIDTH = max( 80, WRAP_WIDTH)
     return WRAP_WIDTH
 
-pp = pprint.PrettyPrinter(indent=4, width=width(), underscore_numbers=True).pformat
+def pp(obj) -> str:
+    import pprint
+    return pprint.pformat(obj, indent=4, width=width(), underscore_numbers=True)
+
+
+# Max length of each string in a logged payload (eg an attached file)
+LOG_CHARS = 500
+
+def log_payload(obj) -> None:
+    """Log (debug) a request/response, truncated, and only formatted if debug logging is enabled"""
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return
+    def truncated(obj):
+        if isinstance(obj, str) and len(obj) > LOG_CHARS:
+            return obj[:LOG_CHARS] + f'... [{len(obj)} chars]'
+        if isinstance(obj, dict):
+            return { k: truncated(v) for k, v in obj.items() }
+        if isinstance(obj, list):
+            return [ truncated(v) for v in obj ]
+        return obj
+    # The caller, rather than this function, in the log
+    logging.debug(pp(truncated(obj)), stacklevel=2)
 
-rich_console = rich.console.Console()
+
+@functools.cache
+def console():
+    import rich.console
+    return rich.console.Console()
 
 
 # Min word length for saving for subsequent tab-completion
 LEN_THRESH = 8
 
-def tokenize(*strings):
-    """Return a prioritized list of (long-ish) unique tokens from strings.
+def token_counts(*strings) -> dict:
+    """Return the counts of (long-ish) tokens in strings.
 
     Sequences of tokens in Title Case are kept as one token. That's useful for
     acronyms and proper nouns (eg names of people, organizations, etc)
     """
+    import regex
     counts = {}
     for s in strings:
         tokens = s.split()
@@ -166,23 +216,122 @@ def tokenize(*strings):
             if len(term) < LEN_THRESH: continue
             counts[term] = counts.get(term, 0) + 1
 
+    return counts
+
+
+def tokenize(*strings):
+    """Return a prioritized list of (long-ish) unique tokens from strings."""
+    counts = token_counts(*strings)
     return sorted(counts.keys(), key=lambda x: counts[x], reverse=True)
 
 
-def highlight_long_tokens(string):
-    """These are the tokens that will be tab-completable in readline
+def normalize(string: str) -> str:
+    """Key for accent-insensitive, case-insensitive matching"""
+    from unidecode import unidecode
+    return unidecode(string).casefold()
 
-    So, highlight them in the response
+
+class CompletionIndex:
+    """Incremental index of tokens, for tab-completion
+
+    New strings (eg history lines, assistant responses) are tokenized just once,
+    when ingested. The frequency of each token is counted.
+    The normalized (accent/case-insensitive) keys are kept sorted,
+    so that a prefix lookup is a bisection, plus the k matches.
     """
 
-    string = regex.sub(
-        # NB, an fr'string' needs to duplicate {{braces}} to escape them
-        fr'\b(\w{{{LEN_THRESH},}})\b',
-        Style.BRIGHT + r'\1' + Style.RESET_ALL,
-        string
-    )
+    def __init__(self):
+        # token => frequency
+        self.counts = {}
+        # Sorted (normalized, token) pairs
+        self.keys = []
+        # The matches of the most recent prefix, since readline asks for each `state`
+        self.cache = (None, [])
+        # Number of readline history items already ingested
+        self.history_len = 0
+
+    def ingest(self, *strings) -> None:
+        new = []
+        for t, n in token_counts(*strings).items():
+            if t not in self.counts:
+                self.counts[t] = 0
+                new.append((normalize(t), t))
+            self.counts[t] += n
+        if new:
+            # Cheaper than insort()'ing each, since timsort merges the sorted runs
+            self.keys += new
+            self.keys.sort()
+        self.cache = (None, [])
+
+    def ingest_history(self) -> None:
+        """Ingest any readline history items that were added since the last time"""
+        length = rl.get_current_history_length()
+        # Eg after /revert removed some items
+        self.history_len = min(self.history_len, length)
+        items = [ rl.get_history_item(i) for i in range(self.history_len + 1, length + 1) ]
+        self.history_len = length
+        # NB, items can be None, if removed
+        self.ingest(*filter(None, items))
+
+    def complete(self, prefix: str) -> list:
+        """Tokens matching prefix, most frequent first"""
+        if self.cache[0] == prefix:
+            return self.cache[1]
+        key = normalize(prefix)
+        matches = []
+        i = bisect.bisect_left(self.keys, (key,))
+        while i < len(self.keys) and self.keys[i][0].startswith(key):
+            matches.append(self.keys[i][1])
+            i += 1
+        matches.sort(key=self.counts.get, reverse=True)
+        self.cache = (prefix, matches)
+        return matches
+
+
+completion_index = CompletionIndex()
+
+
+def highlight_long_tokens(tokens: list) -> None:
+    """These are the tokens that will be tab-completable in readline
 
-    return string
+    So, highlight them (bold) in the response, in its parsed Markdown tokens.
+    Only in the text, not in any code. And only the first occurrence of each,
+    since every highlight is another styled span for rich to render.
+    """
+    from markdown_it.token import Token
+
+    # NB, an fr'string' needs to duplicate {{braces}} to escape them
+    pattern = re.compile(fr'\b(\w{{{LEN_THRESH},}})\b')
+    seen = set()
+    for token in tokens:
+        if token.type != 'inline' or not token.children:
+            continue
+        children = []
+        for child in token.children:
+            if child.type != 'text':
+                children.append(child)
+                continue
+            # The odd parts are the long tokens. Plain parts are joined back together.
+            text = ''
+            for i, part in enumerate(pattern.split(child.content)):
+                if i % 2 and part not in seen:
+                    seen.add(part)
+                    children.append(Token('text', '', 0, content=text))
+                    children.append(Token('strong_open', 'strong', 1))
+                    children.append(Token('text', '', 0, content=part))
+                    children.append(Token('strong_close', 'strong', -1))
+                    text = ''
+                else:
+                    text += part
+            children.append(Token('text', '', 0, content=text))
+        token.children = children
+
+
+@functools.lru_cache(maxsize=4096)
+def wrap_line(line: str, width: int) -> tuple:
+    """Wrap one line (cached, since a streamed response re-wraps the same lines on every refresh)"""
+    # line_wrap = textwrap.wrap(line, WRAP_WIDTH, replace_whitespace=False, drop_whitespace=True)
+    return tuple(textwrap.wrap(line, width, replace_whitespace=False, drop_whitespace=False)) or ('',)
 
 
 def wrapper(string, end=''):
@@ -190,53 +339,809 @@ def wrapper(string, end=''):
 
     end: set to eg two spaces ('  ') to make line breaks explicit with Markdown
 
+    Code blocks are left as-is, since rich wraps those itself,
+    and then the code copied (from the parsed Markdown) is still the original.
     """
 
     # TODO: use textwrap to do the indent as well?
     WRAP_WIDTH = width()
+    indent = ' ' * INDENT
     lines_wrapped = []
+    fenced = False
     for line in string.splitlines():
-        # line_wrap = textwrap.wrap(line, WRAP_WIDTH, replace_whitespace=False, drop_whitespace=True)
-        line_wrap = textwrap.wrap(line, WRAP_WIDTH, replace_whitespace=False, drop_whitespace=False)
-        line_wrap = line_wrap or ['']
-        # line_wrap += end
-        lines_wrapped += line_wrap
-    indent = ' ' * INDENT
-    string = indent + (end + '\n' + indent).join(lines_wrapped)
-    return string
+        if fenced:
+            # Only a bare ``` closes a code block
+            fenced = line.strip() != '```'
+            lines_wrapped.append(indent + line)
+        elif line.lstrip().startswith('```'):
+            fenced = True
+            lines_wrapped.append(indent + line)
+        else:
+            lines_wrapped += [ indent + l + end for l in wrap_line(line, WRAP_WIDTH) ]
+    return '\n'.join(lines_wrapped)
+
+
+def markdown(string: str, highlight=False) -> 'rich.markdown.Markdown':
+    """Parse a response string as Markdown, once, for display and post-processing
+
+    highlight: also highlight the long (tab-completable) tokens
+    """
+    import rich.markdown
+
+    md = rich.markdown.Markdown(wrapper(string, end='  '))
+    if highlight:
+        highlight_long_tokens(md.parsed)
+    return md
 
 
 def render(string: str) -> None:
     """Render a response string as Markdown
 
     Code blocks will also be syntax-highlighted.
-    Code blocks will also be copied to clipboard.
+    The last code block will also be copied to clipboard.
     """
 
+    md = markdown(string, highlight=True)
     # Render/print as markdown
-    rich_console.print(rich.markdown.Markdown(wrapper(string, end='  ')))
+    console().print(md)
     print()
 
-    # Split on ``` and process every odd block as code, eg to copy to clipboard
-    # Try to re-assemble, to also make modifications to the non-code text?
-    processed = ''
-    sections = string.split('```')
-    for i, section in enumerate(sections):
-        if i % 2 == 0:
-            # Non-code block
-            processed += highlight_long_tokens(section)
-            continue
-        else:
-            lang, code = section.split('\n', 1)
-            code = code.strip('\n')
-            pyperclip.copy(code)
-            processed += f'\n```{lang}\n' + code + '\n```\n'
+    postprocess(md)
 
-    processed = wrapper(processed, end='  ')
 
-    # Render/print as markdown
-    # rich_console.print(rich.markdown.Markdown(processed))
-    # print()
+def render_stream(deltas, turn=None) -> str:
+    """Render a streamed response incrementally as Markdown, as it arrives
+
+    deltas: a generator of text fragments, eg from get_response_stream()
+    turn: a dict (from Stats.new()) to record the time spent rendering in, if any
+
+    Ctrl-C aborts the stream, but keeps the partial response.
+    Returns the (possibly partial) response string, empty if aborted before any of it.
+    """
+    import rich.console
+    import rich.live
+    import rich.text
+
+    def view(md):
+        # Below the response, the next prompt, if one is being typed ahead
+        if type_ahead and type_ahead.line:
+            return rich.console.Group(md, rich.text.Text('> ' + type_ahead.line, style='dim'))
+        return md
+
+    string = ''
+    # Re-parsing the Markdown for every delta gets expensive for long responses
+    REFRESH_SECS = 1 / 10
+    refreshed = 0
+    # Default overflow ellipsis while streaming, but the final refresh shows it all
+    with rich.live.Live(console=console(), auto_refresh=False) as live:
+        try:
+            for delta in deltas:
+                string += delta
+                if time.monotonic() - refreshed > REFRESH_SECS:
+                    with timer(turn, 'render'):
+                        live.update(view(markdown(string)), refresh=True)
+                    refreshed = time.monotonic()
+        except KeyboardInterrupt:
+            # Closing the generator keeps the partial response in the messages
+            deltas.close()
+            if not string:
+                # Nothing to render, nor to keep
+                print('^C')
+                return ''
+            string += ' ^C'
+        with timer(turn, 'render'):
+            md = markdown(string, highlight=True)
+            live.update(md, refresh=True)
+    print()
+
+    with timer(turn, 'render'):
+        postprocess(md)
+    return string
+
+
+def postprocess(md: 'rich.markdown.Markdown') -> None:
+    """Post-process a rendered response, eg to copy the last code block to the clipboard
+
+    md: the parsed Markdown of the response, from markdown()
+    """
+    codes = [ token.content.strip('\n') for token in md.parsed if token.type == 'fence' ]
+    if codes:
+        # Rather than copying each one, just for the next to replace it
+        copy_to_clipboard(codes[-1])
+
+
+# The latest (background) write to the clipboard, if any
+clipboard_writer: Optional[threading.Thread] = None
+
+
+def copy_to_clipboard(string: str) -> None:
+    """Copy to the clipboard, in the background
+
+    Since pyperclip runs eg xclip in a subprocess for every copy.
+    Not a daemon thread, so that the last copy still completes when exiting.
+    """
+    global clipboard_writer
+
+    def copy():
+        import pyperclip
+        try:
+            pyperclip.copy(string)
+        except pyperclip.PyperclipException as e:
+            logging.warning(e)
+
+    # One at a time, so that the latest copy wins
+    if clipboard_writer:
+        clipboard_writer.join()
+    clipboard_writer = threading.Thread(target=copy)
+    clipboard_writer.start()
+
+
+# Time spent (re-)connecting, per thread, for the current request
+_timing = threading.local()
+
+
+@functools.cache
+def timed_pool_classes() -> dict:
+    """Connection pools (by scheme) whose connections time their (re-)connecting"""
+    import urllib3
+
+    class Timed:
+        # Includes the TLS handshake, for HTTPS
+        def connect(self):
+            start = time.perf_counter()
+            super().connect()
+            _timing.connect = getattr(_timing, 'connect', 0.0) + time.perf_counter() - start
+
+    class TimedHTTPConnection(Timed, urllib3.connection.HTTPConnection): pass
+    class TimedHTTPSConnection(Timed, urllib3.connection.HTTPSConnection): pass
+
+    class TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+        ConnectionCls = TimedHTTPConnection
+
+    class TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+        ConnectionCls = TimedHTTPSConnection
+
+    return { 'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool }
+
+
+class Client:
+    """A pooled HTTP session (keep-alive), with timeouts and retries
+
+    Retries connection errors, and 429/5xx responses, with exponential backoff
+    and jitter, honoring any Retry-After header.
+
+    Keeps latency stats, to show what reusing connections saves:
+    `connect` is the time spent on (TCP+TLS) connecting, 0 for a reused connection.
+    """
+
+    RETRY_STATUS = { 429, 500, 502, 503, 504 }
+
+    def __init__(self, *, timeout=(5, 120), retries=3, backoff=0.5, backoff_max=30, pool_size=4):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self._session = None
+        # (latency, connect) seconds per request, up to the response headers
+        self.latencies = []
+
+    @property
+    def session(self):
+        """The session, created on first use (eg not for a cached response)"""
+        if not self._session:
+            import requests
+            import requests.adapters
+            self._session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.pool_size)
+            adapter.poolmanager.pool_classes_by_scheme = timed_pool_classes()
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        return self._session
+
+    def delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Seconds to wait before the next attempt"""
+        # "Full jitter": random, up to the exponential backoff
+        delay = random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+        if retry_after:
+            try:
+                secs = float(retry_after)
+            except ValueError:
+                # Else it's an HTTP-date
+                import email.utils
+                secs = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+            delay = max(delay, secs)
+        return delay
+
+    def post(self, url, **kwargs) -> 'requests.Response':
+        import requests
+        for attempt in range(self.retries + 1):
+            _timing.connect = 0.0
+            start = time.perf_counter()
+            try:
+                response = self.session.post(url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.delay(attempt)
+                logging.warning(f'{e}\nRetrying in {delay:.1f}s')
+                time.sleep(delay)
+                continue
+            latency = time.perf_counter() - start
+            self.latencies.append((latency, _timing.connect))
+            logging.info(f'{response.status_code} {latency=:.3f}s connect={_timing.connect:.3f}s')
+            if response.status_code not in self.RETRY_STATUS or attempt == self.retries:
+                return response
+            delay = self.delay(attempt, response.headers.get('Retry-After'))
+            logging.warning(f'{response.status_code} {response.reason}\nRetrying in {delay:.1f}s')
+            response.close()
+            time.sleep(delay)
+
+    def summary(self) -> dict:
+        """Latency stats, for fresh vs reused connections"""
+        fresh = [ l for l, c in self.latencies if c ]
+        reused = [ l for l, c in self.latencies if not c ]
+        connects = [ c for l, c in self.latencies if c ]
+        mean = lambda xs: sum(xs) / len(xs) if xs else 0.0
+        return {
+            'requests': len(self.latencies),
+            'connections': len(fresh),
+            'latency_fresh': mean(fresh),
+            'latency_reused': mean(reused),
+            'connect_mean': mean(connects),
+            # Handshakes that keep-alive avoided
+            'connect_saved': mean(connects) * len(reused),
+        }
+
+
+# Initialized once the CLI args are parsed
+client: Optional[Client] = None
+
+
+class Stats:
+    """Per-turn instrumentation, to show where the time of each turn goes (/stats)
+
+    A ring buffer of the most recent turns. Each turn is a dict of the model, the seconds spent
+    connecting, to the first byte (or delta), on the whole API response, decoding JSON,
+    rendering, generating the title, and the token counts from the `usage` of the response,
+    including the prompt tokens that were cached (server-side) from a previous request.
+    """
+
+    TIMES = ('connect', 'ttfb', 'api', 'decode', 'render', 'title')
+
+    def __init__(self, size=1000):
+        self.turns = collections.deque(maxlen=size)
+
+    def new(self, model: str) -> dict:
+        turn = { 'model': model }
+        self.turns.append(turn)
+        return turn
+
+    @staticmethod
+    def usage(turn: Optional[dict], usage: Optional[dict]) -> None:
+        """Record the token counts of the `usage` of a response"""
+        if turn is None or not usage:
+            return
+        # Or named input/output tokens, by the Responses API (--server-state)
+        turn['prompt_tokens'] = usage.get('prompt_tokens', usage.get('input_tokens', 0))
+        turn['completion_tokens'] = usage.get('completion_tokens', usage.get('output_tokens', 0))
+        details = usage.get('prompt_tokens_details') or usage.get('input_tokens_details') or {}
+        turn['cached_tokens'] = details.get('cached_tokens', 0)
+
+    @staticmethod
+    def cost(turn: dict) -> float:
+        """Estimated cost of a turn, in USD (if the model's price is known)"""
+        price_in, price_cached, price_out = commands['model']['price'].get(turn['model'], (0, 0, 0))
+        cached = turn.get('cached_tokens', 0)
+        return (
+            (turn.get('prompt_tokens', 0) - cached) * price_in + cached * price_cached
+            + turn.get('completion_tokens', 0) * price_out
+        ) / 1e6
+
+    def report(self) -> None:
+        """p50/p95/max of each timing, tokens/sec, prompt caching and cost per model"""
+        print(Style.DIM + f"{len(self.turns)} turns{'':8s}{'p50':>10s}{'p95':>10s}{'max':>10s} ms")
+        for name in self.TIMES:
+            secs = sorted(t[name] for t in self.turns if name in t)
+            if not secs:
+                continue
+            p95 = secs[min(len(secs) - 1, int(len(secs) * .95))]
+            print(f'{name:20s}' + ''.join(f'{x * 1000:10.1f}' for x in (secs[len(secs) // 2], p95, secs[-1])))
+        print(Style.DIM + (
+            f"{'model':20s}{'turns':>10s}{'prompt':>10s}{'cached %':>10s}{'output':>10s}{'tokens/s':>10s}{'cost $':>10s}"
+        ))
+        for model in sorted({ t['model'] for t in self.turns }):
+            turns = [ t for t in self.turns if t['model'] == model ]
+            prompt = sum(t.get('prompt_tokens', 0) for t in turns)
+            cached = sum(t.get('cached_tokens', 0) for t in turns)
+            completion = sum(t.get('completion_tokens', 0) for t in turns)
+            api = sum(t['api'] for t in turns if 'api' in t and 'completion_tokens' in t)
+            print(
+                f'{model:20s}{len(turns):10d}{prompt:10d}{cached / prompt * 100 if prompt else 0:10.1f}'
+                f"{completion:10d}{completion / api if api else 0:10.1f}{sum(map(self.cost, turns)):10.4f}"
+            )
+        if regenerated := [ t for t in self.turns if 'alternatives' in t ]:
+            print(Style.DIM + (
+                f"Alternatives (/regenerate): {len(regenerated)} requests, "
+                f"{sum(t['alternatives'] for t in regenerated)} answers, "
+                f"{sum(t.get('prompt_tokens', 0) for t in regenerated)} + "
+                f"{sum(t.get('completion_tokens', 0) for t in regenerated)} extra tokens, "
+                f"${sum(map(self.cost, regenerated)):.4f}"
+            ))
+        # Approx. latency saved by prompt caching: the time to the first byte, with vs without a cache hit
+        hits = [ t['ttfb'] for t in self.turns if 'ttfb' in t and t.get('cached_tokens') ]
+        misses = [ t['ttfb'] for t in self.turns if 'ttfb' in t and 'cached_tokens' in t and not t['cached_tokens'] ]
+        if hits and misses:
+            mean = lambda xs: sum(xs) / len(xs)
+            saved = mean(misses) - mean(hits)
+            print(Style.DIM + (
+                f'Prompt cache hits: {len(hits)}/{len(hits) + len(misses)} turns, '
+                f'ttfb {mean(hits) * 1000:.0f} vs {mean(misses) * 1000:.0f} ms, '
+                f'approx. {saved * len(hits):.1f}s saved'
+            ))
+
+
+stats = Stats()
+
+
+@contextlib.contextmanager
+def timer(turn: Optional[dict], name: str):
+    """Add the time spent in the block to the turn's (Stats) timing `name`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if turn is not None:
+            turn[name] = turn.get(name, 0.0) + time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def profiled():
+    """With --profile, print the cProfile stats of the block (eg a turn) to stderr"""
+    if not args.profile:
+        yield
+        return
+    import cProfile
+    import pstats
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        # Also for other viewers, eg: snakeviz chatgpt-cli.py.prof
+        profile.dump_stats(__file__ + '.prof')
+        pstats.Stats(profile, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
+
+
+# Tokens to keep free in the context window, for the response
+REPLY_TOKENS = 4096
+# Approx. overhead of each message (role, delimiters), in tokens
+MSG_TOKENS = 4
+
+
+@functools.cache
+def encoding(model: str):
+    """The tokenizer of the model, if the optional `tiktoken` is installed"""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Newer models than this tiktoken knows about
+        return tiktoken.get_encoding('o200k_base')
+
+
+# NB, the hash of a str is cached, so the lookup of an existing message is cheap
+@functools.lru_cache(maxsize=4096)
+def count_tokens(string: str, model: str) -> int:
+    if enc := encoding(model):
+        return len(enc.encode(string, disallowed_special=()))
+    # Rule of thumb for English, without a tokenizer
+    return len(string) // 4 + 1
+
+
+def msg_tokens(msg: dict, model: str) -> int:
+    return count_tokens(msg['content'], model) + MSG_TOKENS
+
+
+def context_limit(model: str) -> int:
+    """Max tokens to send to the model"""
+    if args.budget:
+        return args.budget
+    return commands['model']['context'].get(model, 8192) - REPLY_TOKENS
+
+
+# Summaries of spans of older messages, by the hash of the span
+summaries = {}
+
+
+def summarize(msgs, /, *, model) -> dict:
+    """Summarize a span of messages into a single (system) message (cached)"""
+    span = '\n\n'.join(f"{m['role']}: {m['content']}" for m in msgs)
+    digest = hashlib.sha256(span.encode()).hexdigest()
+    if digest not in summaries:
+        # Make sure the request for the summary itself fits
+        span = span[:context_limit(model) * 4 // 2]
+        prompt = (
+            'Summarize this earlier part of a conversation, concisely, '
+            'keeping any facts, names, numbers and conclusions that might be referred to later.'
+        )
+        summary = get_response(
+            msgs=[ { 'role': 'user', 'content': span }, { 'role': 'system', 'content': prompt } ],
+            key=key,
+            model=args.title_model or model,
+        )
+        if not summary:
+            return None
+        summaries[digest] = summary
+    return { 'role': 'system', 'content': 'Summary of the earlier conversation:\n' + summaries[digest] }
+
+
+# Messages to drop (or summarize) at a time, when compacting
+DROP_BLOCK = 8
+
+
+def stable_prefix(msgs: list) -> list:
+    """Move any attached files up, next to the instructions, ahead of the conversation
+
+    The API caches the longest prompt prefix that it has seen recently. So the long-lived
+    messages (instructions, files) go first, in a stable order, and the volatile ones
+    (the conversation, shell output, retrieved passages) after them.
+    """
+    pinned = { id(a['msg']) for a in attachments }
+    # The leading system messages are already in the prefix
+    head = 0
+    while head < len(msgs) and msgs[head]['role'] == 'system':
+        head += 1
+    if not any(id(m) in pinned for m in msgs[head:]):
+        return msgs
+    return (
+        msgs[:head]
+        + [ m for m in msgs[head:] if id(m) in pinned ]
+        + [ m for m in msgs[head:] if id(m) not in pinned ]
+    )
+
+
+def fit_context(msgs, /, *, model, policy='drop') -> list:
+    """Return the messages to send, compacted to fit within the model's context window
+
+    The leading system messages (custom instructions, files) are kept, as is the last message.
+    policy:
+    drop: drop the oldest messages of the conversation
+    truncate: first truncate the biggest system messages (eg files, shell output)
+    summarize: first replace the older half of the conversation with a summary of it
+
+    Then (still) drop the oldest messages, as necessary.
+    """
+    limit = context_limit(model)
+    total = sum(msg_tokens(m, model) for m in msgs)
+    if total <= limit:
+        return msgs
+
+    msgs = list(msgs)
+    # Leading system messages
+    head = 0
+    while head < len(msgs) - 1 and msgs[head]['role'] == 'system':
+        head += 1
+
+    if policy == 'summarize' and len(msgs) - head > 2:
+        # Whole blocks, so that the same span (and summary) is reused for some turns
+        half = head + max(2, (len(msgs) - head) // 2 // DROP_BLOCK * DROP_BLOCK)
+        if summary := summarize(msgs[head:half], model=model):
+            msgs[head:half] = [ summary ]
+            # Keep the summary, if more still needs to be dropped
+            head += 1
+            total = sum(msg_tokens(m, model) for m in msgs)
+
+    if policy == 'truncate':
+        while total > limit:
+            biggest = max(
+                (i for i, m in enumerate(msgs[:-1]) if m['role'] == 'system'),
+                key=lambda i: msg_tokens(msgs[i], model),
+                default=None,
+            )
+            if biggest is None: break
+            msg = msgs[biggest]
+            tokens = msg_tokens(msg, model)
+            # Smallest worth keeping
+            keep = max(tokens - (total - limit), 256)
+            if keep >= tokens: break
+            # Approx. by the proportion of chars
+            content = msg['content'][:len(msg['content']) * keep // tokens]
+            truncated = { **msg, 'content': content + '\n[... truncated]' }
+            if msg_tokens(truncated, model) >= tokens: break
+            msgs[biggest] = truncated
+            total += msg_tokens(truncated, model) - tokens
+
+    # Drop the oldest ones, after the leading system messages.
+    # In whole blocks, so that the start of the conversation stays the same for some turns,
+    # rather than shifting on every turn, which would break the (server-side) prompt cache.
+    dropped = 0
+    while (total > limit or dropped % DROP_BLOCK) and head < len(msgs) - 1:
+        total -= msg_tokens(msgs.pop(head), model)
+        dropped += 1
+
+    return msgs
+
+
+class ResponseCache:
+    """On-disk cache of responses, keyed by a hash of the request (model, params, messages)
+
+    Only for deterministic (temperature 0) requests.
+    Entries expire after `ttl` seconds. When over `size` bytes, the least recently used
+    are evicted (a hit touches the file's mtime).
+    """
+
+    def __init__(self, dir: str, *, size: int, ttl: float):
+        self.dir = dir
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(dir, exist_ok=True)
+
+    @staticmethod
+    def key(data: dict) -> Optional[str]:
+        # Nor the continuation of a server-side conversation, which the key can't identify
+        if data.get('temperature') != 0 or 'previous_response_id' in data:
+            return None
+        # Streamed or not, it's the same response
+        data = { k: v for k, v in data.items() if k not in ('stream', 'stream_options') }
+        return hashlib.sha256(request_body(data)).hexdigest()
+
+    def get(self, data: dict) -> Optional[str]:
+        if not (key := self.key(data)):
+            return None
+        path = os.path.join(self.dir, key + '.json')
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.unlink(path)
+                raise FileNotFoundError(path)
+            with open(path) as file:
+                content = json.load(file)['content']
+            # Most recently used
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        logging.info(f'Cache hit: {path}')
+        return content
+
+    def put(self, data: dict, content: str) -> None:
+        if not (key := self.key(data)):
+            return
+        import tempfile
+        path = os.path.join(self.dir, key + '.json')
+        # Atomically, via a temp file of its own, in case of concurrent threads/processes (of the same key)
+        fd, tmp = tempfile.mkstemp(dir=self.dir, suffix='.tmp')
+        with open(fd, 'w') as file:
+            json.dump({ 'model': data['model'], 'content': content }, file)
+        try:
+            os.replace(tmp, path)
+        except FileNotFoundError:
+            # Eg removed by the evict() of another process
+            pass
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove expired entries, then the least recently used, until under the size limit"""
+        now = time.time()
+        entries = []
+        # NB, another thread/process may remove any entry meanwhile, which is just as good
+        for entry in os.scandir(self.dir):
+            if not entry.name.endswith('.json'): continue
+            try:
+                stat = entry.stat()
+                if now - stat.st_mtime > self.ttl:
+                    os.unlink(entry.path)
+                    continue
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.size: break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def summary(self) -> dict:
+        return { 'hits': self.hits, 'misses': self.misses }
+
+
+# Initialized once the CLI args are parsed, if --cache
+response_cache: Optional[ResponseCache] = None
+
+
+class ServerState:
+    """The conversation, kept server-side (--server-state), via the Responses API
+
+    The API stores each response, along with the conversation up to it. So a turn only sends
+    the messages after those of a previous response, with its `previous_response_id`.
+    The local messages remain a mirror of it, for /revert, /clear, /messages, etc. After those,
+    a turn continues from an earlier response (whose messages are still a prefix), else resends
+    all of the messages. As it also does once a response has expired server-side.
+    """
+
+    def __init__(self, size=100):
+        # (messages, id) of the recent responses, where the messages are the (local) ones up to it
+        self.responses = collections.deque(maxlen=size)
+        # Eg the TitleWorker, concurrently
+        self.lock = threading.Lock()
+
+    def previous(self, msgs: list) -> tuple:
+        """The id of the latest response that the messages continue, and the messages after it"""
+        with self.lock:
+            for sent, id in reversed(self.responses):
+                # The same message, with the same content (eg not since /expand'ed)
+                if len(sent) < len(msgs) and all(
+                    m is msg and content is msg['content'] for (m, content), msg in zip(sent, msgs)
+                ):
+                    return id, msgs[len(sent):]
+        return None, msgs
+
+    def add(self, msgs: list, id: str) -> None:
+        with self.lock:
+            self.responses.append(([ (m, m['content']) for m in msgs ], id))
+
+    def expired(self, response: 'requests.Response') -> bool:
+        """Whether the request failed since its previous response is no longer stored"""
+        if response.ok:
+            return False
+        try:
+            code = loads(response.content)['error'].get('code')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return False
+        if code != 'previous_response_not_found':
+            return False
+        with self.lock:
+            self.responses.clear()
+        return True
+
+
+server_state = ServerState()
+
+
+def request_data(msgs, /, *, model) -> dict:
+    """The request (body) for the messages, compacted to fit the context window, if necessary"""
+    data = {
+        # 'max_tokens': 50,
+        'temperature': 0,
+        'model': model,
+        # The long-lived messages first, for the prompt cache
+        'messages': stable_prefix(msgs),
+        # TODO the (reasoning) o1(-preview) model(s) can add this:
+        # 'reasoning_effort': 'medium', # low, medium, high
+        # TODO make that a /effort cmd ?
+    }
+    tokens = sum(msg_tokens(m, model) for m in data['messages'])
+    if (msgs := fit_context(data['messages'], model=model, policy=args.compact)) is not data['messages']:
+        compacted = sum(msg_tokens(m, model) for m in msgs)
+        print(Style.DIM + f'Compacted ({args.compact}): {tokens} => {compacted} tokens', file=sys.stderr)
+        tokens = compacted
+    # A copy, since the response will be appended to the messages
+    data['messages'] = list(msgs)
+    logging.info(f'{model=} {tokens=}')
+    return data
+
+
+@functools.cache
+def orjson():
+    """The faster JSON encoder/decoder, if the optional `orjson` is installed"""
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson
+
+
+def dumps(obj) -> bytes:
+    # Sorted keys, so that the same request is also the same (cache) key
+    if fast := orjson():
+        return fast.dumps(obj, option=fast.OPT_SORT_KEYS)
+    return json.dumps(obj, sort_keys=True).encode()
+
+
+def loads(data):
+    if fast := orjson():
+        return fast.loads(data)
+    return json.loads(data)
+
+
+# NB, like count_tokens(), the hash of the (same) content str is cached, so a lookup is cheap
+@functools.lru_cache(maxsize=4096)
+def message_json(role: str, content: str) -> bytes:
+    return dumps({ 'role': role, 'content': content })
+
+
+def request_body(data: dict) -> bytes:
+    """The JSON of the request, joined from the (cached) JSON of each message
+
+    So that each turn only encodes the new messages, rather than the whole conversation.
+    """
+    # The `input` of the Responses API (--server-state) is also a list of messages
+    name = 'input' if 'input' in data else 'messages'
+    rest = dumps({ k: v for k, v in data.items() if k != name })
+    msgs = b','.join(
+        message_json(m['role'], m['content']) if len(m) == 2 and 'content' in m and 'role' in m else dumps(m)
+        for m in data.get(name, [])
+    )
+    # Splice the messages into the (closing brace of the) rest of the object
+    return rest[:-1] + (b',' if len(rest) > 2 else b'') + b'"%s":[' % name.encode() + msgs + b']}'
+
+
+def turn_data(msgs, prompt='', /, *, model, resend=False) -> dict:
+    """The request for the next response to the messages
+
+    With --server-state, for the Responses API: just the messages since the previous response
+    (unless `resend`). Else, for the chat completions API: all of the messages.
+    """
+    if not args.server_state:
+        return request_data(with_retrieved(msgs, prompt), model=model)
+    id, new = (None, msgs) if resend else server_state.previous(msgs)
+    if id is None:
+        data = request_data(with_retrieved(msgs, prompt), model=model)
+        data['input'] = data.pop('messages')
+    else:
+        data = {
+            'temperature': 0,
+            'model': model,
+            'previous_response_id': id,
+            'input': with_retrieved(list(new), prompt),
+        }
+        logging.info(f'{model=} {id=} messages={len(new)}')
+    # Else the server would fail once the whole (server-side) conversation exceeds the context window
+    data['truncation'] = 'auto'
+    data['store'] = True
+    return data
+
+
+def post_turn(data, msgs, prompt='', /, *, key, model, stream=False) -> tuple:
+    """Post the request (from turn_data()), and resend it all, if the previous response expired
+
+    Returns the request data (as sent, finally) and the response.
+    """
+    response = post_data(data, key=key, stream=stream)
+    if 'previous_response_id' in data and server_state.expired(response):
+        print(Style.DIM + 'Server-side conversation expired, resending it', file=sys.stderr)
+        response.close()
+        data = turn_data(msgs, prompt, model=model, resend=True)
+        response = post_data(data, key=key, stream=stream)
+    return data, response
+
+
+def output_text(response_json: dict) -> str:
+    """The content of a (non-streamed) response, of either API"""
+    if 'output' in response_json:
+        # Responses API: the (text) parts of the message(s) of the output items
+        return ''.join(
+            part['text']
+            for item in response_json['output'] if item['type'] == 'message'
+            for part in item['content'] if part['type'] == 'output_text'
+        )
+    return response_json['choices'][0]['message']['content']
+
+
+def post_data(data, /, *, key, stream=False) -> 'requests.Response':
+    url = args.base_url.rstrip('/') + ('/responses' if 'input' in data else '/chat/completions')
+    headers = {
+        'Authorization': 'Bearer ' + key,
+        'Content-Type': 'application/json',
+    }
+    if stream and 'input' in data:
+        # The Responses API always ends with the `usage`, in the response.completed event
+        data = { **data, 'stream': True }
+    elif stream:
+        # The final chunk then has the `usage` (token counts) too
+        data = { **data, 'stream': True, 'stream_options': { 'include_usage': True } }
+    log_payload(data)
+    return client.post(url, data=request_body(data), headers=headers, stream=stream)
 
 
 def get_response(
@@ -246,38 +1151,1276 @@ def get_response(
     msgs=[],
     key,
     model,
+    turn=None,
     ) -> Optional[str]:
+    """Get the response to the prompt (appended to the messages)
+
+    turn: a dict (from Stats.new()) to record the timings and token counts in, if any
+    """
     global messages
     if not msgs:
         msgs = messages
         if prompt:
             msgs.append({ 'role': 'user', 'content': prompt })
-    url = 'https://api.openai.com/v1/chat/completions'
-    headers = {
-        'Authorization': 'Bearer ' + key,
-        'Content-Type': 'application/json',
-    }
-    data = {
-        # 'max_tokens': 50,
-        'temperature': 0,
-        'model': model,
-        'messages': msgs,
-        # TODO the (reasoning) o1(-preview) model(s) can add this:
-        # 'reasoning_effort': 'medium', # low, medium, high
-        # TODO make that a /effort cmd ?
-    }
-    logging.debug(pp(data))
-    response = requests.post(url, data=json.dumps(data), headers=headers)
-    response_json = response.json()
-    if 'error' in response_json:
+    data = turn_data(msgs, prompt, model=model)
+    if response_cache and (content := response_cache.get(data)) is not None:
+        msgs.append({ 'role': 'assistant', 'content': content })
+        if turn is not None:
+            turn['cached'] = True
+        return content
+    import requests
+    try:
+        with timer(turn, 'api'):
+            data, response = post_turn(data, msgs, prompt, key=key, model=model)
+        with timer(turn, 'decode'):
+            response_json = loads(response.content)
+    except (requests.RequestException, ValueError) as e:
+        print(Fore.RED + str(e))
+        return
+    if turn is not None:
+        turn['connect'] = _timing.connect
+        # Up to the response headers
+        turn['ttfb'] = response.elapsed.total_seconds()
+        Stats.usage(turn, response_json.get('usage'))
+    # NB, a response of the Responses API always has an `error`, null if none
+    if response_json.get('error'):
         print(response_json['error'])
         return
-    logging.debug(pp(response_json))
-    content = response_json['choices'][0]['message']['content']
+    log_payload(response_json)
+    content = output_text(response_json)
     msgs.append({ 'role': 'assistant', 'content': content })
+    if 'input' in data:
+        server_state.add(msgs, response_json['id'])
+    if response_cache:
+        response_cache.put(data, content)
     return content
 
 
+def get_response_stream(
+    prompt='',
+    /,
+    *,
+    msgs=[],
+    key,
+    model,
+    turn=None,
+    ):
+    """Like get_response(), but yield the response incrementally, as it arrives
+
+    Uses server-sent events (SSE). When the generator is closed early (eg Ctrl-C),
+    the partial response received so far is still appended to the messages.
+    """
+    global messages
+    if not msgs:
+        msgs = messages
+        if prompt:
+            msgs.append({ 'role': 'user', 'content': prompt })
+    data = turn_data(msgs, prompt, model=model)
+    if response_cache and (content := response_cache.get(data)) is not None:
+        msgs.append({ 'role': 'assistant', 'content': content })
+        if turn is not None:
+            turn['cached'] = True
+        yield content
+        return
+    import requests
+    start = time.perf_counter()
+    try:
+        data, response = post_turn(data, msgs, prompt, key=key, model=model, stream=True)
+        if not response.ok:
+            print(response.json().get('error'))
+            return
+    except requests.RequestException as e:
+        print(Fore.RED + str(e))
+        return
+    # SSE is UTF-8, but requests doesn't assume that without a charset
+    response.encoding = 'utf-8'
+    if turn is not None:
+        turn['connect'] = _timing.connect
+    deltas = []
+    done = False
+    decode = 0.0
+    # Of the Responses API (--server-state)
+    response_id = None
+    try:
+        # chunk_size=None: yield data as soon as it arrives, rather than buffering
+        for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+            if not line.startswith('data:'): continue
+            payload = line.removeprefix('data:').strip()
+            if payload == '[DONE]':
+                # Keep reading to the end of the body, so the connection can be reused
+                done = True
+                continue
+            decoding = time.perf_counter()
+            chunk = loads(payload)
+            decode += time.perf_counter() - decoding
+            if 'error' in chunk or chunk.get('type') in ('error', 'response.failed'):
+                print(chunk.get('error') or chunk.get('message') or chunk['response'].get('error'))
+                break
+            if chunk.get('type') == 'response.completed':
+                # Responses API: the end, without a [DONE]
+                response_id = chunk['response']['id']
+                Stats.usage(turn, chunk['response'].get('usage'))
+                done = True
+                continue
+            # The last chunk, without choices
+            Stats.usage(turn, chunk.get('usage'))
+            if chunk.get('type') == 'response.output_text.delta':
+                texts = [ chunk['delta'] ]
+            else:
+                texts = [ choice.get('delta', {}).get('content') for choice in chunk.get('choices', []) ]
+            for delta in texts:
+                if delta:
+                    if not deltas and turn is not None:
+                        turn['ttfb'] = time.perf_counter() - start
+                    deltas.append(delta)
+                    yield delta
+    finally:
+        response.close()
+        if turn is not None:
+            # NB, this includes the time spent rendering the deltas so far
+            turn['api'] = time.perf_counter() - start
+            turn['decode'] = decode
+        if deltas:
+            content = ''.join(deltas)
+            log_payload(content)
+            msgs.append({ 'role': 'assistant', 'content': content })
+            # Else the partial response is only local, and the next turn resends (from) its question
+            if response_id:
+                server_state.add(msgs, response_id)
+            # But not a partial (aborted) response
+            if response_cache and done:
+                response_cache.put(data, content)
+
+
+def compare(prompt: str, models: list) -> Optional[str]:
+    """Ask several models concurrently, and render each answer as it arrives
+
+    Without a prompt, re-asks the previous question (replacing its answer).
+    Then the chosen answer is appended to the messages (and returned).
+    """
+    import concurrent.futures
+    if unknown := [ m for m in models if m not in commands['model']['choices'] ]:
+        print(Fore.RED + f'Unknown models: {unknown}')
+        return
+    # The answer being replaced, if re-asking
+    previous = None
+    if prompt:
+        messages.append({ 'role': 'user', 'content': prompt })
+    elif messages and messages[-1]['role'] == 'assistant':
+        previous = messages.pop()
+    if not messages or messages[-1]['role'] != 'user':
+        print(Fore.RED + 'No question to compare answers to')
+        return
+    context = list(messages)
+
+    def ask(model):
+        turn = stats.new(model)
+        # Each its own copy of the conversation, to append its answer to
+        msgs = list(context)
+        return model, get_response(prompt, msgs=msgs, key=key, model=model, turn=turn), turn
+
+    answers = []
+    # The (shared) client pools a connection per concurrent request
+    with concurrent.futures.ThreadPoolExecutor(len(models)) as pool:
+        futures = [ pool.submit(ask, model) for model in models ]
+        for future in concurrent.futures.as_completed(futures):
+            model, content, turn = future.result()
+            if not content:
+                continue
+            answers.append(content)
+            hr()
+            print(
+                Style.BRIGHT + f'[{len(answers)}] {model}' + Style.RESET_ALL + Style.DIM +
+                f"  {turn.get('api', 0):.2f}s  {turn.get('prompt_tokens', 0)} + {turn.get('completion_tokens', 0)} tokens"
+                f"  ${Stats.cost(turn):.4f}" + (' (cached)' if turn.get('cached') else '')
+            )
+            render(content)
+    if not answers:
+        # Else the next turn would follow a question without an answer
+        if previous:
+            messages.append(previous)
+        else:
+            messages.pop()
+        return
+    choice = 1
+    if args.interactive and len(answers) > 1:
+        try:
+            reply = input(Style.BRIGHT + f'Keep which answer? (1-{len(answers)}, default 1): ').strip()
+        except (KeyboardInterrupt, EOFError):
+            reply = ''
+        if reply:
+            # Not a question, for the readline history
+            rl.remove_history_item(rl.get_current_history_length() - 1)
+        if reply.isdigit() and 1 <= int(reply) <= len(answers):
+            choice = int(reply)
+    if previous and args.store:
+        # Remove the previous answer (like a /revert), the next sync stores this one
+        conversation_store().sync(messages[int(bool(args.instructions)):], model=args.model)
+    messages.append({ 'role': 'assistant', 'content': answers[choice - 1] })
+    return answers[choice - 1]
+
+
+# The answers to the last question, for /regenerate to cycle through
+alternatives = { 'question': None, 'temperature': None, 'choices': [], 'index': 0 }
+
+def regenerate(temperature: float) -> Optional[str]:
+    """Replace the last answer with an alternative one, at the given temperature
+
+    The first time (for this question and temperature), a single request gets --alternatives
+    of them (n>1). Then each /regenerate just cycles through those, and back to the original.
+    """
+    if len(messages) < 2 or messages[-1]['role'] != 'assistant':
+        print(Fore.RED + 'No answer to regenerate')
+        return
+    question = messages[-2]
+    if alternatives['question'] is not question or alternatives['temperature'] != temperature:
+        turn = stats.new(args.model)
+        # The extra tokens, for /stats
+        turn['alternatives'] = args.alternatives
+        # NB, the Responses API (--server-state) has no `n`, but the messages are all local anyway
+        data = request_data(with_retrieved(messages[:-1], question['content']), model=args.model)
+        data.update(temperature=temperature, n=args.alternatives)
+        print(Style.DIM + f'Generating {args.alternatives} alternatives (temperature {temperature}) ...')
+        import requests
+        try:
+            with timer(turn, 'api'):
+                response_json = loads(post_data(data, key=key).content)
+        except (requests.RequestException, ValueError) as e:
+            print(Fore.RED + str(e))
+            return
+        if response_json.get('error'):
+            print(response_json['error'])
+            return
+        Stats.usage(turn, response_json.get('usage'))
+        alternatives.update(
+            question=question,
+            temperature=temperature,
+            # The original answer first
+            choices=[ messages[-1]['content'] ] + [ c['message']['content'] for c in response_json['choices'] ],
+            index=0,
+        )
+    alternatives['index'] = (alternatives['index'] + 1) % len(alternatives['choices'])
+    content = alternatives['choices'][alternatives['index']]
+    if args.store:
+        # Remove the previous answer (like a /revert), the next sync stores this one
+        conversation_store().sync(messages[int(bool(args.instructions)):-1], model=args.model)
+    messages[-1] = { 'role': 'assistant', 'content': content }
+    hr()
+    print(Style.DIM + (
+        f"[{alternatives['index']}/{len(alternatives['choices']) - 1}] temperature {temperature}"
+        if alternatives['index'] else '[original]'
+    ))
+    render(content)
+    return content
+
+
+def batch_item(line: str, context: list) -> dict:
+    """Get the response to one line of a batch: a prompt, or a JSON object
+
+    The JSON object has a 'prompt', and optionally a 'model' and 'instructions'
+    (instead of the custom instructions).
+    context: the leading messages of each prompt (instructions, files)
+    """
+    try:
+        item = json.loads(line) if line.startswith('{') else { 'prompt': line }
+        model = item.get('model', args.model)
+        if 'instructions' in item:
+            # Replacing any custom instructions
+            context = context[int(bool(args.instructions)):]
+            context = [ { 'role': 'system', 'content': item['instructions'] } ] + context
+        result = { 'prompt': item['prompt'], 'model': model }
+        if not isinstance(item['prompt'], str):
+            raise TypeError("'prompt' is not a string")
+        if not isinstance(item.get('instructions', ''), str):
+            raise TypeError("'instructions' is not a string")
+        if model not in commands['model']['choices']:
+            raise ValueError(f'Unknown model: {model!r}')
+    except (ValueError, KeyError, TypeError) as e:
+        # Just this line fails, not the whole batch
+        return { 'line': line, 'error': f'Invalid line: {e!r}' }
+    data = request_data(context + [ { 'role': 'user', 'content': item['prompt'] } ], model=model)
+    start = time.perf_counter()
+    if response_cache and (content := response_cache.get(data)) is not None:
+        return { **result, 'response': content, 'cached': True, 'latency': time.perf_counter() - start }
+    import requests
+    try:
+        # The client retries rate limits (429) with backoff
+        response_json = loads(post_data(data, key=key).content)
+    except (requests.RequestException, ValueError) as e:
+        return { **result, 'error': str(e) }
+    if 'error' in response_json:
+        return { **result, 'error': response_json['error'] }
+    content = response_json['choices'][0]['message']['content']
+    if response_cache:
+        response_cache.put(data, content)
+    return {
+        **result,
+        'response': content,
+        'latency': time.perf_counter() - start,
+        'usage': response_json.get('usage'),
+    }
+
+
+def batch(file, /, *, jobs: int) -> None:
+    """Get the responses to the prompts in a file (one per line), concurrently
+
+    Prints the results as JSON lines, in the same order as the prompts.
+    At most 2 * jobs prompts are pending at a time, so the file can be a stream.
+    """
+    import concurrent.futures
+    context = list(messages)
+    lines = ( line.strip() for line in file )
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        pending = collections.deque()
+        for n, line in enumerate(filter(None, lines)):
+            pending.append((n, pool.submit(batch_item, line, context)))
+            # Print (in order) what's ready
+            while pending and (len(pending) >= 2 * jobs or pending[0][1].done()):
+                n, future = pending.popleft()
+                print(json.dumps({ 'n': n, **future.result() }), flush=True)
+        for n, future in pending:
+            print(json.dumps({ 'n': n, **future.result() }), flush=True)
+
+
+def read_stream_chunks(file, /, *, chars: int):
+    """Yield chunks of a stream (eg stdin), of up to about `chars` each, at line breaks
+
+    In bounded memory: a longer line is split too.
+    """
+    chunk, size = [], 0
+    for line in iter(lambda: file.readline(chars), ''):
+        if chunk and size + len(line) > chars:
+            yield ''.join(chunk)
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line)
+    if chunk:
+        yield ''.join(chunk)
+
+
+MAP_PROMPT = """\
+{prompt}
+
+The input is too long to send at once, so this is just part {n} of it. Answer from this part only, \
+concisely. The answers of all of the parts will then be combined.
+```
+{chunk}
+```
+"""
+
+REDUCE_PROMPT = """\
+{prompt}
+
+The input was too long to send at once, so it was split into parts, each answered separately. \
+Combine these answers of the parts (in order) into one answer.
+
+{answers}
+"""
+
+
+def map_reduce(file, prompt: str, /, *, jobs: int) -> None:
+    """Answer the prompt about a long (piped) input, in chunks, then combine their answers
+
+    Map: the chunks are read from the stream as needed, with at most 2 * jobs pending, and up to
+    `jobs` requests at a time. Reduce: the answers are combined, in as many (concurrent) rounds
+    as needed to fit the context window, the last one as the response.
+    A journal of the answers so far lets a re-run of the same command resume after a failed chunk.
+    An input of just one chunk is simply answered, as a single request.
+    """
+    import concurrent.futures
+    prompt = prompt.strip() or 'Summarize it.'
+    context = list(messages)
+    model = args.model
+
+    def respond(content: str) -> Optional[str]:
+        """The last request, in the conversation, as the response"""
+        turn = stats.new(model)
+        if args.stream:
+            print()
+            return render_stream(get_response_stream(content, key=key, model=model, turn=turn), turn)
+        if response := get_response(content, key=key, model=model, turn=turn):
+            print()
+            render(response)
+        return response
+
+    # Approx. 4 chars per token, as for attached files
+    chunks = read_stream_chunks(file, chars=args.chunk_tokens * 4)
+    first, second = next(chunks, None), next(chunks, None)
+    if first is None:
+        return
+    if second is None:
+        # As without --map-reduce
+        respond(prompt + '\n```\n' + first + '\n```\n')
+        return
+    chunks = itertools.chain([ first, second ], chunks)
+    # Of the same question (and model, instructions, files), about any input
+    job = hashlib.sha256(dumps([ model, prompt, context ])).hexdigest()[:16]
+    journal_dir = os.path.join(os.path.expanduser(args.cache_dir), 'map-reduce')
+    os.makedirs(journal_dir, exist_ok=True)
+    journal_path = os.path.join(journal_dir, job + '.jsonl')
+    # The answers to previous runs, by the hash of their chunk
+    journal = {}
+    if os.path.exists(journal_path):
+        with open(journal_path) as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                    journal[entry['chunk']] = entry['answer']
+                except (ValueError, KeyError):
+                    # Eg the last line of an interrupted run
+                    continue
+
+    def ask(content: str) -> Optional[str]:
+        try:
+            return get_response(msgs=context + [ { 'role': 'user', 'content': content } ], key=key, model=model, turn=stats.new(model))
+        except Exception as e:
+            logging.error(e)
+
+    answers = {}
+    read = resumed = failed = 0
+    def progress(end=''):
+        print(
+            f'\rMap: {len(answers)}/{read} chunks answered' + (f', {resumed} resumed' if resumed else '')
+            + (f', {failed} failed' if failed else ''), end=end, file=sys.stderr, flush=True,
+        )
+
+    with open(journal_path, 'a') as journal_file, concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        pending = {}
+        def finish(future):
+            nonlocal failed
+            n, hash = pending.pop(future)
+            if answer := future.result():
+                answers[n] = answer
+                journal_file.write(json.dumps({ 'chunk': hash, 'n': n, 'answer': answer }) + '\n')
+                journal_file.flush()
+            else:
+                failed += 1
+            progress()
+
+        for n, chunk in enumerate(chunks, 1):
+            read += 1
+            hash = hashlib.sha256(chunk.encode()).hexdigest()
+            if hash in journal:
+                answers[n] = journal[hash]
+                resumed += 1
+                progress()
+                continue
+            future = pool.submit(ask, MAP_PROMPT.format(prompt=prompt, n=n, chunk=chunk))
+            pending[future] = (n, hash)
+            # Bounded memory: wait for some to finish, before reading more
+            while len(pending) >= 2 * jobs:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    finish(future)
+        for future in concurrent.futures.as_completed(list(pending)):
+            finish(future)
+    progress(end='\n')
+    if failed:
+        print(Fore.RED + f'{failed} chunks failed. Re-run the same command to resume', file=sys.stderr)
+        sys.exit(1)
+    if not answers:
+        return
+
+    # As many rounds as it takes for the answers to fit (half of) the context window
+    parts = [ answers[n] for n in sorted(answers) ]
+    while True:
+        groups, group, tokens = [], [], 0
+        for part in parts:
+            if group and tokens + count_tokens(part, model) > context_limit(model) // 2:
+                groups.append(group)
+                group, tokens = [], 0
+            group.append(part)
+            tokens += count_tokens(part, model)
+        groups.append(group)
+        if len(groups) == len(parts):
+            # Each part is too big to group with another, so pairs of them, else this never ends
+            groups = [ parts[i:i + 2] for i in range(0, len(parts), 2) ]
+        prompts = [
+            REDUCE_PROMPT.format(prompt=prompt, answers='\n\n'.join(f'## Part {i}\n\n{p}' for i, p in enumerate(group, 1)))
+            for group in groups
+        ]
+        if len(prompts) == 1:
+            break
+        print(Style.DIM + f'Reduce: {len(parts)} answers => {len(prompts)}', file=sys.stderr)
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            parts = list(pool.map(ask, prompts))
+        if not all(parts):
+            print(Fore.RED + 'Failed to combine the answers. Re-run the same command to resume', file=sys.stderr)
+            sys.exit(1)
+
+    if respond(prompts[0]):
+        os.unlink(journal_path)
+
+
+def serve(path: str) -> None:
+    """Run as a resident daemon, answering questions over a Unix socket, eg from ./chatgpt-client.py
+
+    Keeps the warm state: imports, the pooled (keep-alive) connection, the instructions
+    and any --file's (as the context of every question), the completion index, caches.
+
+    Protocol: the client sends one line of JSON, with a 'prompt', and optionally a 'model'.
+    The (raw Markdown) response is streamed back, until the socket is closed.
+    Or, a 'complete' prefix gets the tab-completions of it, one per line.
+    """
+    import socket
+    import socketserver
+
+    # The context of each question: any instructions and files
+    context = list(messages)
+    lock = threading.Lock()
+
+    class Stdout(threading.local):
+        """sys.stdout, or the client, in a handler thread, eg for the API errors of its request"""
+        def __init__(self):
+            self.client = None
+        def write(self, string: str) -> int:
+            if self.client:
+                # Plain text, like the response
+                self.client.write(re.sub(r'\x1b\[[0-9;]*m', '', string).encode())
+                return len(string)
+            return stdout.write(string)
+        def __getattr__(self, name):
+            return getattr(stdout, name)
+
+    stdout = sys.stdout
+    sys.stdout = Stdout()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            sys.stdout.client = self.wfile
+            try:
+                self.answer()
+            except BrokenPipeError:
+                pass
+            finally:
+                sys.stdout.client = None
+
+        def answer(self):
+            try:
+                item = json.loads(self.rfile.readline())
+                if not isinstance(item, dict):
+                    raise ValueError('not a JSON object')
+                if 'complete' in item and not isinstance(item['complete'], str):
+                    raise ValueError("'complete' is not a string")
+                if 'complete' not in item and not (isinstance(item.get('prompt'), str) and item['prompt'].strip()):
+                    raise ValueError("no 'prompt'")
+                if item.get('model') and item['model'] not in commands['model']['choices']:
+                    raise ValueError(f"unknown model: {item['model']}")
+            except ValueError as e:
+                self.wfile.write(f'Invalid request: {e}\n'.encode())
+                return
+            if 'complete' in item:
+                with lock:
+                    completions = completion_index.complete(item['complete'])
+                self.wfile.write(''.join(c + '\n' for c in completions).encode())
+                return
+            model = item.get('model') or args.model
+            msgs = context + [ { 'role': 'user', 'content': item['prompt'] } ]
+            deltas = get_response_stream(item['prompt'], msgs=msgs, key=key, model=model, turn=stats.new(model))
+            try:
+                for delta in deltas:
+                    self.wfile.write(delta.encode())
+                    self.wfile.flush()
+            except BrokenPipeError:
+                # The client went away (eg Ctrl-C), which aborts the request too
+                deltas.close()
+            if msgs[-1]['role'] == 'assistant':
+                with lock:
+                    completion_index.ingest(msgs[-1]['content'])
+                    if args.store:
+                        conversation_store().new()
+                        conversation_store().sync(msgs[int(bool(args.instructions)):], model=model)
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        # Unless a daemon is still listening on it, it's stale, eg of a daemon that was killed
+        probe = socket.socket(socket.AF_UNIX)
+        try:
+            probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+        else:
+            sys.exit(f'A daemon is already listening on {path}')
+        finally:
+            probe.close()
+    # Only for this user, since requests are sent with their API key
+    umask = os.umask(0o077)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    print(f'Listening on {path}', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+# Approx. size of each chunk of an attached file, in tokens
+CHUNK_TOKENS = 1000
+
+# Attached (chunks of) files: dicts of file, lines, tokens, and the message
+attachments = []
+
+
+def is_binary(file_name: str) -> bool:
+    """Guess if a file is binary, from (just) its first few KB"""
+    with open(file_name, 'rb') as file:
+        return b'\0' in file.read(8192)
+
+
+def read_chunks(file_name: str, /, *, lines=None, pattern=None):
+    """Yield (first, last, text) chunks of a text file, of about CHUNK_TOKENS each
+
+    The file is memory-mapped, and read line by line, so that a big file isn't read into memory.
+    lines: (first, last) line numbers to include (1-based, inclusive)
+    pattern: only include lines matching this regex (prefixed with their line number)
+    """
+    # Approx, since counting exactly would mean decoding every line
+    chunk_chars = CHUNK_TOKENS * 4
+    first, last = lines or (1, math.inf)
+    pattern = pattern and re.compile(pattern)
+    with open(file_name, 'rb') as file:
+        if not os.fstat(file.fileno()).st_size:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            chunk, size, start = [], 0, None
+            for n, line in enumerate(iter(mm.readline, b''), 1):
+                if n < first: continue
+                if n > last: break
+                line = line.decode(errors='replace')
+                if pattern:
+                    if not pattern.search(line): continue
+                    line = f'{n}: {line}'
+                start, end = start or n, n
+                chunk.append(line)
+                size += len(line)
+                if size >= chunk_chars:
+                    yield start, n, ''.join(chunk)
+                    chunk, size, start = [], 0, None
+            if chunk:
+                yield start, end, ''.join(chunk)
+
+
+def rank_chunks(chunks, query: str, k: int) -> list:
+    """The (up to) k chunks most relevant to the query, by a simple lexical ranking, in file order
+
+    Only k chunks are kept in memory at a time.
+    """
+    terms = { normalize(t) for t in re.findall(r'\w{3,}', query) }
+    def score(chunk):
+        text = normalize(chunk[2])
+        # Diminishing returns for repeated terms
+        return sum(math.log1p(text.count(t)) for t in terms)
+    return sorted(heapq.nlargest(k, chunks, key=score))
+
+
+def attach_file(file_name: str, *, lines=None, pattern=None, query=None) -> None:
+    """Attach (chunks of) a text file to the conversation, as system messages
+
+    The whole file, if it fits in the --file-tokens budget. Else only the selected lines,
+    or the lines matching the pattern, or the chunks most relevant to the query
+    (else the first chunks), up to the budget.
+    """
+    if not os.path.isfile(file_name):
+        print(Fore.RED + f'No such file: {file_name}')
+        return
+    if is_binary(file_name):
+        print(Fore.RED + f'Not a text file: {file_name}')
+        return
+    if pattern:
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            print(Fore.RED + f'Invalid pattern: /{pattern}/: {e}')
+            return
+    chunks = read_chunks(file_name, lines=lines, pattern=pattern)
+    if args.retrieve:
+        # Rather than attaching, the relevant chunks are retrieved for each prompt
+        source = file_name + (f':{lines[0]}-{lines[1]}' if lines else '') + (f':/{pattern}/' if pattern else '')
+        retrieval_index().add_file(source, file_name, chunks)
+        return
+    fits = os.path.getsize(file_name) // 4 <= args.file_tokens
+    if not fits:
+        # Also the selected lines, which can be (nearly) all of a big file
+        k = max(1, args.file_tokens // CHUNK_TOKENS)
+        total = 0
+        def counted(chunks):
+            nonlocal total
+            for chunk in chunks:
+                total += 1
+                yield chunk
+        if query:
+            chunks = rank_chunks(counted(chunks), query, k)
+        else:
+            # One more, to know if any are left out
+            chunks = list(itertools.islice(counted(chunks), k + 1))
+            chunks = chunks[:k]
+        if total > k and query:
+            print(Fore.YELLOW + f'Too big, attaching the {k} (of {total}) chunks of {file_name} most relevant to the question', file=sys.stderr)
+        elif total > k:
+            print(Fore.YELLOW + f'Too big, attaching the first {k} chunks of {file_name} (select by lines, pattern or question)', file=sys.stderr)
+
+    for first, last, text in chunks:
+        msg = {
+            'role': 'system',
+            'content': (
+                f"File:{file_name} (lines {first}-{last})\n"
+                "(Make use of it when answering subsequent questions)\nContent:\n\n" + text
+            ),
+        }
+        messages.append(msg)
+        attachments.append({
+            'file': file_name,
+            'lines': (first, last),
+            'tokens': msg_tokens(msg, args.model),
+            'msg': msg,
+        })
+
+
+def list_attachments() -> None:
+    global attachments
+    # Eg after a /clear
+    attachments = [ a for a in attachments if any(m is a['msg'] for m in messages) ]
+    for a in attachments:
+        first, last = a['lines']
+        print(f"{a['file']}:{first}-{last}" + Style.DIM + f"  {a['tokens']} tokens")
+    print(Style.DIM + f"Total: {sum(a['tokens'] for a in attachments)} tokens")
+
+
+def parse_file_spec(spec: str, /) -> dict:
+    """Parse eg `log.txt`, `log.txt:100-200` or `log.txt:/ERROR|WARN/` into attach_file() args"""
+    if match := re.match(r'^(.+?):(\d+)-(\d+)$', spec):
+        return { 'file_name': match.group(1), 'lines': (int(match.group(2)), int(match.group(3))) }
+    if match := re.match(r'^(.+?):/(.+)/$', spec):
+        return { 'file_name': match.group(1), 'pattern': match.group(2) }
+    return { 'file_name': spec }
+
+
+class ShellOutput:
+    """The output of a shell command, streamed to a (spill) file as it arrives
+
+    Only the head and tail lines are kept in memory, and sent as the message, each cut to LINE_CHARS
+    (eg a line of minified JSON). The rest is elided, but can be expanded later (/expand), from the file.
+    """
+
+    LINE_CHARS = 1000
+
+    def __init__(self, cmd: str, *, lines: int):
+        import tempfile
+        self.cmd = cmd
+        self.head = []
+        self.tail = collections.deque(maxlen=lines - lines // 2)
+        self.head_lines = lines // 2
+        self.lines = 0
+        # Lines cut to LINE_CHARS
+        self.cut = 0
+        self.stdout = []
+        self.lock = threading.Lock()
+        # Closed once the command is done, then re-opened by name (see remove_shell_outputs())
+        self.file = tempfile.NamedTemporaryFile('w+', prefix='chatgpt-shell-', suffix='.txt', delete=False)
+        # The message that the (head/tail of the) output was sent in
+        self.msg = None
+
+    def add(self, line: str, *, stderr=False) -> None:
+        with self.lock:
+            self.file.write(line)
+            self.lines += 1
+            if len(line) > self.LINE_CHARS:
+                line = line[:self.LINE_CHARS] + f' [... {len(line) - self.LINE_CHARS} chars elided ...]\n'
+                self.cut += 1
+            if len(self.head) < self.head_lines:
+                self.head.append(line)
+            else:
+                self.tail.append(line)
+            # For the clipboard, within the same cap
+            if not stderr and len(self.stdout) < self.head_lines:
+                self.stdout.append(line)
+
+    @property
+    def elided(self) -> int:
+        return self.lines - len(self.head) - len(self.tail)
+
+    def text(self) -> str:
+        """The head and tail of the output, and where any elided lines are"""
+        n = shell_outputs.index(self) + 1
+        marker = []
+        if self.elided:
+            marker = [ f'\n[... {self.elided} lines elided, /expand {n} to include them ...]\n\n' ]
+        end = []
+        if self.cut:
+            end = [ f'\n[... {self.cut} long lines cut, /expand {n} to include them ...]\n' ]
+        return ''.join(self.head + marker + list(self.tail) + end)
+
+    def full(self) -> str:
+        with self.lock:
+            if not self.file.closed:
+                # Eg a background job, still running
+                self.file.flush()
+            with open(self.file.name) as file:
+                return file.read()
+
+
+# Shell command outputs (ShellOutput), eg to /expand
+shell_outputs = []
+
+# Background (&) shell commands: (thread, ShellOutput)
+shell_jobs = []
+
+
+def remove_shell_outputs() -> None:
+    """Remove the (spill) files of the shell outputs, eg on exit, or before a /reload"""
+    for output in shell_outputs:
+        output.file.close()
+        try:
+            os.unlink(output.file.name)
+        except FileNotFoundError:
+            pass
+
+
+atexit.register(remove_shell_outputs)
+
+
+def run_shell(output: ShellOutput, /, *, background=False) -> None:
+    """Run a shell command, streaming its output (to the terminal, unless background) as it arrives"""
+    shell_outputs.append(output)
+    # Allow running (bash) functions/aliases
+    # TODO doc the '$' wrapper, maybe add it as an example to the repo ?
+    source = f'$ {output.cmd}'
+    proc = subprocess.Popen(
+        source,
+        shell=True,
+        text=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        # A background job mustn't read the terminal, nor get the Ctrl-C's meant for the prompt
+        stdin=subprocess.DEVNULL if background else None,
+        start_new_session=background,
+    )
+
+    def read(pipe, stderr):
+        for line in pipe:
+            output.add(line, stderr=stderr)
+            if not background:
+                print((Fore.RED if stderr else '') + line, end='', flush=True)
+
+    stderr = threading.Thread(target=read, args=(proc.stderr, True), daemon=True)
+    stderr.start()
+    try:
+        read(proc.stdout, False)
+        proc.wait()
+    except KeyboardInterrupt:
+        # The command got the SIGINT too. Keep what it output so far.
+        print('^C')
+        proc.wait()
+    stderr.join()
+    # Else a file descriptor per command, for the rest of the session
+    with output.lock:
+        output.file.close()
+
+
+def add_shell_output(output: ShellOutput) -> None:
+    """Add the (head/tail of the) output of a shell command to the messages"""
+    messages.append( { 'role': 'user',   'content': '$ ' + output.cmd } )
+    if args.retrieve:
+        # Rather than attaching, the relevant chunks of the output are retrieved for each prompt
+        retrieval_index().add(f'$ {output.cmd} #{len(messages)}', read_chunks(output.file.name))
+        content = '(Output indexed, relevant parts are retrieved for subsequent questions)'
+    else:
+        content = output.text()
+    output.msg = { 'role': 'system', 'content': content }
+    messages.append(output.msg)
+
+
+def expand_shell_output(n: int) -> None:
+    """Replace the head/tail of the n-th shell output, in its message, with all of it"""
+    if not 0 < n <= len(shell_outputs):
+        print(Fore.RED + f'No such shell output: {n}')
+        return
+    output = shell_outputs[n - 1]
+    if not any(msg is output.msg for msg in messages):
+        print(Fore.RED + f'No longer in the conversation: $ {output.cmd}')
+        return
+    output.msg['content'] = output.full()
+    if args.store:
+        # Remove it (and what followed) from the stored thread, the next sync stores it (them) again
+        i = next(i for i, msg in enumerate(messages) if msg is output.msg)
+        conversation_store().sync(messages[int(bool(args.instructions)):i], model=args.model)
+    print(Style.DIM + f'Expanded: $ {output.cmd} ({output.lines} lines, {msg_tokens(output.msg, args.model)} tokens)')
+
+
+def shell_job(cmd: str) -> None:
+    """Run a shell command in the background, to be added to the messages when done"""
+    output = ShellOutput(cmd, lines=args.shell_lines)
+    thread = threading.Thread(target=run_shell, args=(output,), kwargs={ 'background': True }, daemon=True)
+    thread.start()
+    shell_jobs.append((thread, output))
+    print(Style.DIM + f'Running in the background: $ {cmd}')
+
+
+def list_shell_jobs() -> None:
+    for thread, output in shell_jobs:
+        print(Style.DIM + f'$ {output.cmd} ({output.lines} lines so far)')
+
+
+def finish_shell_jobs() -> None:
+    """Add the output of any finished background jobs to the messages (in the main thread)"""
+    for job in list(shell_jobs):
+        thread, output = job
+        if thread.is_alive():
+            continue
+        shell_jobs.remove(job)
+        print(Style.DIM + f'Done: $ {output.cmd} ({output.lines} lines)')
+        add_shell_output(output)
+
+
+@functools.cache
+def db() -> 'sqlite3.Connection':
+    """The local database (opened on first use)"""
+    import sqlite3
+    os.makedirs(os.path.dirname(args.db), exist_ok=True)
+    # isolation_level=None: autocommit, unless in an explicit transaction
+    return sqlite3.connect(args.db, isolation_level=None, check_same_thread=False)
+
+
+class RetrievalIndex:
+    """A local full-text index of passages, eg chunks of attached files, shell output
+
+    An inverted index, ranked by BM25, via SQLite's FTS5. No network needed.
+    It's persisted, so unmodified files don't need re-indexing.
+    Only the sources added in this session are searched.
+    """
+
+    def __init__(self, conn: 'sqlite3.Connection'):
+        self.conn = conn
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sources (
+                source TEXT PRIMARY KEY,
+                mtime REAL,
+                size INTEGER
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS passages USING fts5(
+                source UNINDEXED,
+                lines UNINDEXED,
+                text,
+                tokenize = 'unicode61 remove_diacritics 2'
+            );
+        """)
+        # Passages not from files (eg shell output) are only kept for a session
+        self.conn.execute('DELETE FROM passages WHERE source NOT IN (SELECT source FROM sources)')
+        self.sources = set()
+
+    def add_file(self, source: str, file_name: str, chunks) -> None:
+        """Index the chunks of a file, unless already indexed, and not modified since"""
+        stat = os.stat(file_name)
+        self.sources.add(source)
+        row = self.conn.execute('SELECT mtime, size FROM sources WHERE source = ?', (source,)).fetchone()
+        if row == (stat.st_mtime, stat.st_size):
+            return
+        with self.conn:
+            self.conn.execute('BEGIN')
+            self.conn.execute('DELETE FROM passages WHERE source = ?', (source,))
+            self.conn.executemany(
+                'INSERT INTO passages (source, lines, text) VALUES (?, ?, ?)',
+                ((source, f'{first}-{last}', text) for first, last, text in chunks),
+            )
+            self.conn.execute(
+                'INSERT OR REPLACE INTO sources (source, mtime, size) VALUES (?, ?, ?)',
+                (source, stat.st_mtime, stat.st_size),
+            )
+
+    def add(self, source: str, chunks) -> None:
+        """Index the (first, last, text) chunks of a text that isn't a (persistent) file, eg shell output"""
+        self.sources.add(source)
+        with self.conn:
+            self.conn.execute('BEGIN')
+            self.conn.execute('DELETE FROM passages WHERE source = ?', (source,))
+            self.conn.executemany(
+                'INSERT INTO passages (source, lines, text) VALUES (?, ?, ?)',
+                ((source, f'{first}-{last}', text) for first, last, text in chunks),
+            )
+
+    def search(self, query: str, k: int) -> list:
+        """The k (score, source, lines, text) passages most relevant to the query"""
+        if not (match := fts_query(query)) or not self.sources:
+            return []
+        marks = ','.join('?' * len(self.sources))
+        # NB, bm25() is lower for better matches
+        return self.conn.execute(
+            f'SELECT bm25(passages), source, lines, text FROM passages '
+            f'WHERE passages MATCH ? AND source IN ({marks}) '
+            f'ORDER BY bm25(passages) LIMIT ?',
+            (match, *self.sources, k),
+        ).fetchall()
+
+
+def fts_query(string: str) -> str:
+    """An FTS5 query matching any of the words in string"""
+    terms = set(re.findall(r'\w+', string))
+    # Quoted, so that terms aren't parsed as FTS5 syntax
+    return ' OR '.join('"' + t.replace('"', '""') + '"' for t in terms)
+
+
+@functools.cache
+def retrieval_index() -> RetrievalIndex:
+    return RetrievalIndex(db())
+
+
+def with_retrieved(msgs: list, prompt: str) -> list:
+    """Insert the passages relevant to the prompt before the (last) user message
+
+    From attached files, shell output, and past conversations.
+    """
+    if not (args.retrieve and prompt):
+        return msgs
+    passages = retrieval_index().search(prompt, args.retrieve)
+    if args.store:
+        passages += conversation_store().search_messages(prompt, args.retrieve)
+    # Best (lowest) BM25 scores of both
+    passages = sorted(passages)[:args.retrieve]
+    if not passages:
+        return msgs
+    logging.info('Retrieved:\n' + '\n'.join(f'{source} {lines}' for _, source, lines, _ in passages))
+    content = '\n\n'.join(
+        f"From:{source}" + (f" (lines {lines})" if lines else '') + f"\n{text}"
+        for _, source, lines, text in passages
+    )
+    msg = { 'role': 'system', 'content': 'Passages relevant to the next question:\n\n' + content }
+    return msgs[:-1] + [ msg ] + msgs[-1:]
+
+
+class ConversationStore:
+    """Persistent conversations (threads), with every message, in the local database
+
+    Messages are appended as the conversation goes, with their role, model, timestamp, tokens.
+    Listing recent threads is via an index, searching via a full-text (FTS5) index,
+    and resuming loads just the messages of that one thread.
+    """
+
+    def __init__(self, conn: 'sqlite3.Connection'):
+        self.conn = conn
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS threads (
+                id INTEGER PRIMARY KEY,
+                title TEXT,
+                model TEXT,
+                created REAL,
+                updated REAL
+            );
+            CREATE INDEX IF NOT EXISTS threads_updated ON threads (updated);
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                thread_id INTEGER REFERENCES threads (id),
+                role TEXT,
+                model TEXT,
+                ts REAL,
+                tokens INTEGER,
+                content TEXT
+            );
+            CREATE INDEX IF NOT EXISTS messages_thread ON messages (thread_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                content,
+                content = 'messages',
+                content_rowid = 'id',
+                tokenize = 'unicode61 remove_diacritics 2'
+            );
+        """)
+        self.new()
+
+    def new(self) -> None:
+        """Start a new thread (created on the first message)"""
+        self.thread_id = None
+        # Row ids of the messages (so far) of the current thread
+        self.ids = []
+
+    def sync(self, msgs: list, /, *, model: str, title: Optional[str] = None) -> None:
+        """Append any new messages, or remove any reverted ones, of the current thread"""
+        now = time.time()
+        with self.conn:
+            self.conn.execute('BEGIN')
+            # Eg after /revert
+            while len(self.ids) > len(msgs):
+                id = self.ids.pop()
+                self.conn.execute(
+                    "INSERT INTO messages_fts (messages_fts, rowid, content) "
+                    "SELECT 'delete', id, content FROM messages WHERE id = ?", (id,)
+                )
+                self.conn.execute('DELETE FROM messages WHERE id = ?', (id,))
+            if len(self.ids) == len(msgs):
+                return
+            if self.thread_id is None:
+                self.thread_id = self.conn.execute(
+                    'INSERT INTO threads (model, created, updated) VALUES (?, ?, ?)', (model, now, now),
+                ).lastrowid
+            for msg in msgs[len(self.ids):]:
+                id = self.conn.execute(
+                    'INSERT INTO messages (thread_id, role, model, ts, tokens, content) VALUES (?, ?, ?, ?, ?, ?)',
+                    (self.thread_id, msg['role'], model, now, msg_tokens(msg, model), msg['content']),
+                ).lastrowid
+                self.conn.execute('INSERT INTO messages_fts (rowid, content) VALUES (?, ?)', (id, msg['content']))
+                self.ids.append(id)
+            self.conn.execute(
+                'UPDATE threads SET updated = ?, model = ?, title = COALESCE(?, title) WHERE id = ?',
+                (now, model, title, self.thread_id),
+            )
+
+    # A title, else the start of the first question
+    TITLE = """COALESCE(t.title, (
+        SELECT substr(content, 1, 80) FROM messages WHERE thread_id = t.id AND role = 'user' ORDER BY id LIMIT 1
+    ))"""
+
+    def recent(self, n: int = 20) -> list:
+        """The (id, updated, title) of the most recently updated threads"""
+        return self.conn.execute(
+            f'SELECT t.id, t.updated, {self.TITLE} FROM threads t ORDER BY t.updated DESC LIMIT ?', (n,),
+        ).fetchall()
+
+    def search(self, query: str, n: int = 20) -> list:
+        """The (id, updated, title, snippet) of the threads best matching the query"""
+        if not (match := fts_query(query)):
+            return []
+        # Rank the matching messages first, since FTS5 functions can't be used when grouping
+        return self.conn.execute(
+            f"SELECT t.id, t.updated, {self.TITLE}, s.snippet FROM ("
+            f"    SELECT m.thread_id, bm25(messages_fts) AS score, "
+            f"        snippet(messages_fts, 0, '', '', '...', 12) AS snippet "
+            f"    FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+            f"    WHERE messages_fts MATCH ? ORDER BY score LIMIT 1000"
+            f") s JOIN threads t ON t.id = s.thread_id GROUP BY t.id ORDER BY min(s.score) LIMIT ?",
+            (match, n),
+        ).fetchall()
+
+    def search_messages(self, query: str, k: int) -> list:
+        """The k (score, source, lines, text) messages of other threads most relevant to the query"""
+        if not (match := fts_query(query)):
+            return []
+        return self.conn.execute(
+            f"SELECT bm25(messages_fts), 'conversation: ' || {self.TITLE}, '', m.content "
+            f'FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid JOIN threads t ON t.id = m.thread_id '
+            f'WHERE messages_fts MATCH ? AND t.id IS NOT ? ORDER BY bm25(messages_fts) LIMIT ?',
+            (match, self.thread_id, k),
+        ).fetchall()
+
+    def resume(self, thread_id: int) -> tuple:
+        """Load the (title, messages) of a thread, and continue it"""
+        row = self.conn.execute(f'SELECT {self.TITLE} FROM threads t WHERE t.id = ?', (thread_id,)).fetchone()
+        if not row:
+            return None, []
+        rows = self.conn.execute(
+            'SELECT id, role, content FROM messages WHERE thread_id = ? ORDER BY id', (thread_id,),
+        ).fetchall()
+        self.thread_id = thread_id
+        self.ids = [ id for id, _, _ in rows ]
+        title = (row[0] or '').strip().split('\n')[0]
+        return title, [ { 'role': role, 'content': content } for _, role, content in rows ]
+
+
+@functools.cache
+def conversation_store() -> ConversationStore:
+    return ConversationStore(db())
+
+
+def print_threads(threads: list) -> None:
+    for id, updated, title, *snippet in threads:
+        ts = time.strftime('%Y-%m-%d %H:%M', time.localtime(updated))
+        title = (title or '').strip().split('\n')[0]
+        print(f'#{id:<5d}' + Style.DIM + ts + Style.RESET_ALL + f'  {title}')
+        if snippet:
+            print(Style.DIM + '       ' + snippet[0].replace('\n', ' '))
+
+
+class HistoryFile:
+    """The readline history file, appended to on every turn, rather than rewritten
+
+    Appends (and compaction) hold an exclusive lock (flock) on the file, so that concurrent
+    sessions don't clobber each other's history. Only the most recent `window` entries are
+    loaded, and the file is compacted (deduped, capped to `size` entries) in the background,
+    on startup and then every `COMPACT_EVERY` appended entries.
+
+    NB, an entry already appended stays in the file, even after eg a /revert.
+    """
+
+    COMPACT_EVERY = 100
+
+    def __init__(self, path: str, *, size=10_000, window=1_000):
+        self.path = path
+        self.size = size
+        self.window = window
+        # Length of the readline history, as of the last save
+        self.saved = 0
+        self.appended = 0
+        self.compactor: Optional[threading.Thread] = None
+
+    def load(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        open(self.path, 'a').close()
+        for line in self.tail(self.window):
+            rl.add_history(line)
+        self.saved = rl.get_current_history_length()
+        self.compact_background()
+
+    def tail(self, n: int) -> list:
+        """The last n lines of the file, reading backwards, rather than the whole file"""
+        BLOCK = 64 * 1024
+        with open(self.path, 'rb') as file:
+            end = file.seek(0, os.SEEK_END)
+            data = b''
+            while end > 0 and data.count(b'\n') <= n:
+                start = max(0, end - BLOCK)
+                file.seek(start)
+                data = file.read(end - start) + data
+                end = start
+        lines = data.decode(errors='replace').splitlines()
+        # Unless it's the start of the file, the first line is partial
+        return lines[-n:] if end == 0 else lines[1:][-n:]
+
+    def save(self) -> None:
+        """Append the history entries added since the last save"""
+        import fcntl
+        length = rl.get_current_history_length()
+        # Eg after /revert removed some entries
+        new = length - self.saved
+        if new > 0:
+            with open(self.path, 'a') as file:
+                fcntl.flock(file, fcntl.LOCK_EX)
+                rl.append_history_file(new, self.path)
+            self.appended += new
+        self.saved = length
+        if self.appended >= self.COMPACT_EVERY:
+            self.appended = 0
+            self.compact_background()
+
+    def compact(self) -> None:
+        """Dedupe (keeping the latest of each) and cap the entries of the file, in place"""
+        import fcntl
+        with open(self.path, 'r+', errors='replace') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            lines = file.read().splitlines()
+            # dict keeps the order of insertion, so insert from the latest, then reverse
+            latest = list(dict.fromkeys(reversed(lines)))[:self.size][::-1]
+            if len(latest) == len(lines):
+                return
+            # In place (not a rename), since other sessions might be waiting on the lock of this file
+            file.seek(0)
+            file.write(''.join(line + '\n' for line in latest))
+            file.truncate()
+        logging.info(f'Compacted history: {len(lines)} => {len(latest)} entries')
+
+    def compact_background(self) -> None:
+        if self.compactor and self.compactor.is_alive():
+            return
+        self.compactor = threading.Thread(target=self.compact, daemon=True)
+        self.compactor.start()
+
+
+# Initialized in interactive mode
+history_file: Optional[HistoryFile] = None
+
+
 def editor(content_a: str='', /) -> str:
     """Edit a (multi-line) string, by running your $EDITOR on a temp file
 
@@ -297,8 +2440,6 @@ def editor(content_a: str='', /) -> str:
     return content_b
 
 
-# TODO put this in a class, and maintain the state there, eg a dict/priority queue
-# And then just send new strings to it to be tokenized
 # Alt. modules on PyPI ? https://pypi.org/search/?q=autocomplete
 def completer(prefix: str, state: int) -> str | None :
     """"Tab-completion for readline
@@ -306,35 +2447,41 @@ def completer(prefix: str, state: int) -> str | None :
     Completes tokens from:
     user's readline history, assistant responses, /commands, file names, model names.
 
-    History/conversation tokens are prioritized by frequency/length.
+    History/conversation tokens are prioritized by frequency.
 
     Matches are accent-insensitive, but accent-preserving.
     Matches are case-insensitive, and not case-preserving.
     (unless multi-word, eg. proper nouns)
 
     """
-    completions = []
+    global completions_cache
     if not prefix:
         return None
 
-    # Completions via (current) history session
-    # But, we might want to have /commands in the history still
-    items = [ rl.get_history_item(i) for i in range(1, rl.get_current_history_length() + 1)]
-    for t in tokenize(*items):
-        if unidecode(t).casefold().startswith(unidecode(prefix).casefold()):
-            completions.append(t)
+    # readline calls this for each `state`, for the same prefix, until it gets None
+    if state == 0 or completions_cache[0] != prefix:
+        completions_cache = (prefix, completions(prefix))
+    completions_ = completions_cache[1]
 
-    # TODO merge history/messages, since they're overlapping?
+    if state < len(completions_):
+        return completions_[state]
+
+    if state == 0:
+        # text doesn't match any possible completion
+        beep()
 
-    # TODO assistant messages are not in the readline history, so we need to keep track of them separately
+    return None
 
-    # Complete tokens from (assistant) messages / responses
-    global messages
-    items = [ m['content'] for m in messages if m['role'] == 'assistant' ]
-    for t in tokenize(*items):
-        # print(f'msg:{t}:')
-        if unidecode(t).casefold().startswith(unidecode(prefix).casefold()):
-            completions.append(t)
+
+# (prefix, completions) of the current tab-completion
+completions_cache = (None, [])
+
+
+def completions(prefix: str) -> list:
+    # Completions via the history session, and the (assistant) messages / responses
+    # But, we might want to have /commands in the history still
+    completion_index.ingest_history()
+    completions = list(completion_index.complete(prefix))
 
     # Complete /command names
     global commands
@@ -350,10 +2497,9 @@ def completer(prefix: str, state: int) -> str | None :
         if dir != '/': dir += '/'
         # print(f'\n{dir=}')
         # print(f'\n{bn=}')
-        for file in os.listdir(dir):
-            if not bn or unidecode(file).casefold().startswith(unidecode(bn).casefold()):
-                if os.path.isdir(dir+file): file += '/'
-                # print(f'\n{file=}')
+        bn = normalize(bn)
+        for key, file in dir_cache.list(dir):
+            if key.startswith(bn):
                 completions.append(dir + file)
 
     # Complete model names
@@ -361,14 +2507,74 @@ def completer(prefix: str, state: int) -> str | None :
         if m.casefold().startswith(prefix):
             completions.append(m)
 
-    if state < len(completions):
-        return completions[state]
+    return completions
 
-    if state == 0:
-        # text doesn't match any possible completion
-        beep()
 
-    return None
+class DirCache:
+    """Directory listings, for completing file names, cached by directory and its mtime
+
+    Via os.scandir(), whose entries know if they're a directory (d_type), without a stat of
+    each. Adding/removing/renaming an entry changes the directory's mtime, so a single stat
+    (of the directory) validates its cached listing.
+    """
+
+    # Max directories of the background pre-scan
+    PRESCAN_DIRS = 64
+
+    def __init__(self, size=256):
+        # dir => (mtime, [ (normalized name, name), ... ]), least recently used first
+        self.listings = collections.OrderedDict()
+        self.size = size
+        # Eg the background pre-scan
+        self.lock = threading.Lock()
+
+    def list(self, dir: str) -> list:
+        """The (normalized name, name) of each entry of the directory, with a / if it's a directory"""
+        dir = os.path.normpath(dir)
+        try:
+            mtime = os.stat(dir).st_mtime_ns
+        except OSError:
+            return []
+        with self.lock:
+            if (cached := self.listings.get(dir)) and cached[0] == mtime:
+                self.listings.move_to_end(dir)
+                return cached[1]
+        entries = []
+        try:
+            with os.scandir(dir) as it:
+                for entry in it:
+                    try:
+                        # NB, this only needs a stat for a symlink (or if the filesystem has no d_type)
+                        name = entry.name + '/' if entry.is_dir() else entry.name
+                    except OSError:
+                        name = entry.name
+                    entries.append((normalize(entry.name), name))
+        except OSError:
+            return []
+        entries.sort()
+        with self.lock:
+            self.listings[dir] = (mtime, entries)
+            self.listings.move_to_end(dir)
+            while len(self.listings) > self.size:
+                self.listings.popitem(last=False)
+        return entries
+
+    def prescan(self, dirs: list) -> None:
+        """In the background, cache the directories (and then their subdirectories), up to PRESCAN_DIRS"""
+        def scan():
+            queue = collections.deque(dict.fromkeys(os.path.normpath(d) for d in dirs))
+            for _ in range(self.PRESCAN_DIRS):
+                if not queue:
+                    break
+                dir = queue.popleft()
+                queue.extend(
+                    os.path.join(dir, name) for _, name in self.list(dir)
+                    if name.endswith('/') and not name.startswith('.')
+                )
+        threading.Thread(target=scan, daemon=True).start()
+
+
+dir_cache = DirCache()
 
 
 def beep(n: int = 2):
@@ -385,10 +2591,15 @@ def set_terminal_title(string=''):
     prefix = 'chatgpt-cli'
     string = ' - ' + string
     sys.stdout.write('\x1b]2;' + prefix + string + '\x07')
+    # Since it might be set from a background thread
+    sys.stdout.flush()
 
 
-def get_chat_topic():
-    global messages
+# Max chars of each message to send, when generating a title
+TITLE_CHARS = 1000
+
+
+def get_chat_topic(msgs):
     global args
     prompt = (
             'Generate a one-line title/label/summary for this conversation so far.'
@@ -396,15 +2607,148 @@ def get_chat_topic():
             'Similar to a newspaper headline: a short question or conclusion.'
     )
     msg = { 'role': 'system', 'content': prompt }
+    # The first question/answer is usually enough to go on.
+    # And skip the instructions and any files, to keep it cheap.
+    msgs = [ m for m in msgs if m['role'] != 'system' ][:2]
+    msgs = [ { 'role': m['role'], 'content': m['content'][:TITLE_CHARS] } for m in msgs ]
     title = get_response(
-        # Start from the first non-instruction messages
-        msgs=messages[int(bool(args.instructions)):] + [ msg ],
+        msgs=msgs + [ msg ],
         key=key,
-        model=args.model,
+        model=args.title_model or args.model,
     )
     return title
 
 
+class TitleWorker(threading.Thread):
+    """Generate the conversation title in the background, then set the terminal title
+
+    So that the prompt isn't blocked waiting for it.
+    """
+
+    def __init__(self, msgs, turn=None):
+        super().__init__(daemon=True)
+        # A copy, since the conversation continues in the meantime
+        self.msgs = list(msgs)
+        # To record the time taken, in the (Stats) turn that triggered it
+        self.turn = turn
+        self.title = None
+        self.cancelled = threading.Event()
+
+    def run(self):
+        with timer(self.turn, 'title'):
+            title = get_chat_topic(self.msgs)
+        # Eg after a /clear, this title no longer applies
+        if title and not self.cancelled.is_set():
+            self.title = title
+            set_terminal_title(title)
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+title_worker: Optional[TitleWorker] = None
+
+
+class TypeAhead(threading.Thread):
+    """Read the next prompts, typed while a response is in flight, to queue them for the next turns
+
+    As a context manager, around a turn. The terminal doesn't echo them meanwhile (that would
+    garble the response being rendered). So the line so far is shown below a streamed response,
+    and each line is printed once it's queued. Ctrl-C still aborts (only) the response.
+    Any unfinished line is then put back at the (readline) prompt, to finish editing.
+    """
+
+    # Typed ahead, but not yet finished, eg while the next turn is also from the queue
+    unfinished = ''
+
+    def __init__(self, queue: collections.deque):
+        super().__init__(daemon=True)
+        self.queue = queue
+        # The line typed so far
+        self.line = TypeAhead.unfinished
+        self.stopped = threading.Event()
+        self.attrs = None
+
+    def __enter__(self):
+        global type_ahead
+        if not sys.stdin.isatty():
+            return self
+        import termios
+        import tty
+        self.attrs = termios.tcgetattr(sys.stdin)
+        # A char at a time, without echo, but Ctrl-C is still a SIGINT. NB, TCSANOW, else it drops what's typed
+        tty.setcbreak(sys.stdin, termios.TCSANOW)
+        type_ahead = self
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        global type_ahead
+        type_ahead = None
+        if not self.attrs:
+            return
+        import termios
+        self.stopped.set()
+        self.join()
+        termios.tcsetattr(sys.stdin, termios.TCSANOW, self.attrs)
+        TypeAhead.unfinished = self.line
+        def startup_hook():
+            rl.insert_text(TypeAhead.unfinished)
+            TypeAhead.unfinished = ''
+            rl.set_startup_hook()
+        if self.line:
+            rl.set_startup_hook(startup_hook)
+
+    def run(self):
+        import codecs
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        escape = False
+        while not self.stopped.is_set():
+            if not select.select([ sys.stdin ], [], [], .05)[0]:
+                continue
+            for char in decoder.decode(os.read(sys.stdin.fileno(), 1024)):
+                if escape:
+                    # Skip the rest of eg an arrow key (ESC [ A)
+                    escape = not (char.isalpha() or char == '~')
+                elif char == '\x1b':
+                    escape = True
+                elif char in '\r\n':
+                    if line := self.line.strip():
+                        self.queue.append(line)
+                        print(Style.DIM + f'Queued: {line}')
+                    self.line = ''
+                elif char in '\x7f\b':
+                    self.line = self.line[:-1]
+                elif char == '\x15':
+                    # Ctrl-U
+                    self.line = ''
+                elif char.isprintable():
+                    self.line += char
+
+
+# While a turn is in flight
+type_ahead: Optional[TypeAhead] = None
+
+
+def startup_profile() -> None:
+    """Print a breakdown of the startup time, to catch regressions
+
+    Including each of the deferred imports (incremental, in order).
+    For the whole tree of imports: python -X importtime chatgpt-cli.py --startup-profile
+    """
+    import importlib
+    print(f"{'imports (eager)':20s}{(IMPORTED - START) * 1000:8.1f} ms")
+    print(f"{'init, parse args':20s}{(time.perf_counter() - IMPORTED) * 1000:8.1f} ms")
+    for module in DEFERRED_IMPORTS:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            print(f"{module:20s}{'-':>8s}    (not installed)")
+            continue
+        print(f"{module:20s}{(time.perf_counter() - start) * 1000:8.1f} ms")
+
+
 def usage():
     print("See:\nhttps://platform.openai.com/usage")
 
@@ -425,16 +2769,29 @@ commands['copy'] = {
     'desc': 'Copy the last assistant response to the clipboard',
 }
 commands['cp'] = commands['copy']
+commands['compare'] = {
+    'desc': 'Ask several models (concurrently), then choose which answer to continue with. '
+            'Without a question, re-asks the previous one',
+    'example': '/compare gpt-4o,gpt-4.1 some question',
+}
 commands['edit'] = {
     'desc': 'Edit the last user message in external $EDITOR',
 }
 commands['file'] = {
-    'desc': 'List/attach files to the conversation/dialogue. TODO ',
-    'example': '/file ./data.csv',
+    'desc': 'List/attach files (or line ranges, or matching lines, or chunks relevant to a query)',
+    'example': '/file ./data.log:100-200 | /file ./data.log:/ERROR/ | /file ./data.log disk full',
+}
+commands['expand'] = {
+    'desc': 'Include all of the (elided) output of a !shell command',
+    'example': '/expand 2',
+}
+commands['jobs'] = {
+    'desc': 'List the background !shell commands (run with a trailing &) still running',
+    'example': '!make test &',
 }
 commands['history'] = {
-    'desc': 'List/resume previous conversation/dialogue. TODO ',
-    # 'example': '/history 3',
+    'desc': 'List/search/resume previous conversations/dialogues',
+    'example': '/history | /history 3 | /history some search terms',
 }
 commands['messages'] = {
     'desc': 'List the messages in this conversation/dialogue',
@@ -444,6 +2801,23 @@ commands['model'] = {
     'desc': 'Get/set the OpenAI model to target',
     'example': '/model gpt-4-turbo',
     'choices':['gpt-3.5-turbo', 'gpt-4', 'gpt-4-turbo', 'gpt-4o', 'gpt-4.1'],
+    # Context window of each model, in tokens
+    'context': {
+        'gpt-3.5-turbo':    16_385,
+        'gpt-4':             8_192,
+        'gpt-4-turbo':     128_000,
+        'gpt-4o':          128_000,
+        'gpt-4.1':       1_047_576,
+    },
+    # Approx. price of each model, in USD per 1M (input, cached input, output) tokens, for the /stats estimates
+    # cf. https://openai.com/pricing
+    'price': {
+        'gpt-3.5-turbo':  (0.50,  0.50,  1.50),
+        'gpt-4':         (30.00, 30.00, 60.00),
+        'gpt-4-turbo':   (10.00, 10.00, 30.00),
+        'gpt-4o':         (2.50,  1.25, 10.00),
+        'gpt-4.1':        (2.00,  0.50,  8.00),
+    },
 }
 commands['reload'] = {
     'desc': 'Reload the CLI',
@@ -452,12 +2826,15 @@ commands['revert'] = {
     'desc': 'Revert/remove the previous user message (and assistant reply)',
 }
 commands['regenerate'] = {
-    'desc': 'Regenerate the last response, optionally with higher temp. (percent) TODO',
+    'desc': 'Regenerate the last response, optionally with higher temp. (percent, default 100). Again to cycle through them',
     'example': '/regenerate 99',
 }
 commands['title'] = {
     'desc': 'Get/set a (new) title/topic of the conversation/dialogue TODO',
 }
+commands['stats'] = {
+    'desc': 'Show where the time of recent turns went (p50/p95/max), tokens/sec and estimated cost per model',
+}
 commands['usage'] = {
     'desc': 'Show the OpenAI API usage/quota/spend TODO',
 }
@@ -471,6 +2848,12 @@ parser.add_argument(
     type=str,
     help="Path to file containing your OpenAI API key, else use env var OPENAI_API_KEY",
 )
+parser.add_argument(
+    '--base-url',
+    type=str,
+    help="Base URL of the (OpenAI-compatible) API, eg of ./mock-server.py, default: env var OPENAI_BASE_URL, else https://api.openai.com/v1",
+    default=os.environ.get('OPENAI_BASE_URL', 'https://api.openai.com/v1'),
+)
 parser.add_argument(
     '-i',
     '--interactive',
@@ -483,7 +2866,15 @@ parser.add_argument(
     type=str,
     action='append', # Collect into a list
     default=[],
-    help="Path to a file to upload/analyze. Accepts multiple --file args.",
+    help="Path to a file to upload/analyze. Accepts multiple --file args. "
+         "Select lines via path:START-END or path:/REGEX/",
+)
+parser.add_argument(
+    '--file-tokens',
+    type=int,
+    default=32_000,
+    help="Max tokens to attach per file. Bigger files are chunked, and the chunks most relevant "
+         "to the question are attached, default: %(default)s",
 )
 parser.add_argument(
     '--instructions',
@@ -500,17 +2891,183 @@ parser.add_argument(
     # default to most recent model
     default=commands['model']['choices'][-1],
 )
+parser.add_argument(
+    '--compare',
+    type=lambda string: string.split(','),
+    metavar='MODEL,MODEL,...',
+    help="Ask several models each question, concurrently, and show all the answers, "
+         "to choose one to continue with (the first to arrive, if not interactive)",
+)
+parser.add_argument(
+    '--title-model',
+    type=str,
+    help="OpenAI model for generating conversation titles, eg a cheaper one, default: --model",
+)
+parser.add_argument(
+    '--retrieve',
+    type=int,
+    default=0,
+    metavar='K',
+    help="Index --file's and shell output locally, rather than attaching them, "
+         "and send only the K passages most relevant to each question",
+)
+parser.add_argument(
+    '--db',
+    type=str,
+    help="Path to the local database (conversations, retrieval index), default ~/.config/chatgpt/chatgpt.sqlite",
+    default='~/.config/chatgpt/chatgpt.sqlite',
+)
+parser.add_argument(
+    '--store',
+    action=argparse.BooleanOptionalAction,
+    default=True,
+    help="Save conversations (all messages) to the --db, for /history",
+)
+parser.add_argument(
+    '--cache',
+    action=argparse.BooleanOptionalAction,
+    default=False,
+    help="Cache responses to identical (temperature 0) requests on disk, default: %(default)s",
+)
+parser.add_argument(
+    '--cache-dir',
+    type=str,
+    help="Path to the response cache, default ~/.cache/chatgpt",
+    default='~/.cache/chatgpt',
+)
+parser.add_argument(
+    '--cache-size',
+    type=float,
+    default=100,
+    help="Max size of the response cache, in MB, default: %(default)s",
+)
+parser.add_argument(
+    '--cache-ttl',
+    type=float,
+    default=30,
+    help="Max age of cached responses, in days, default: %(default)s",
+)
+parser.add_argument(
+    '--budget',
+    type=int,
+    help="Max tokens to send per request, default: the model's context window (less room for the response)",
+)
+parser.add_argument(
+    '--compact',
+    choices=['drop', 'truncate', 'summarize'],
+    default='drop',
+    help="How to fit a long conversation into the budget: drop the oldest messages, "
+         "truncate big system messages (files, shell output), or summarize older messages, "
+         "default: %(default)s. Token counts are exact if `tiktoken` is installed.",
+)
+parser.add_argument(
+    '--stream',
+    action=argparse.BooleanOptionalAction,
+    default=True,
+    help="Render the response incrementally, as it arrives (Ctrl-C to abort it)",
+)
+parser.add_argument(
+    '--connect-timeout',
+    type=float,
+    default=5,
+    help="Seconds to wait for a connection to the API, default: %(default)s",
+)
+parser.add_argument(
+    '--read-timeout',
+    type=float,
+    default=120,
+    help="Seconds to wait for (more of) the response, default: %(default)s",
+)
+parser.add_argument(
+    '--retries',
+    type=int,
+    default=3,
+    help="Retries on connection errors, rate limits (429) and server errors (5xx), default: %(default)s",
+)
+parser.add_argument(
+    '--server-state',
+    action='store_true',
+    help="Keep the conversation server-side (Responses API), so that each turn only sends its new "
+         "messages, rather than the whole conversation. Resends it all, if it expired server-side",
+)
+parser.add_argument(
+    '--alternatives',
+    type=int,
+    default=3,
+    help="Alternative answers to get (in one request) for /regenerate to cycle through, default: %(default)s",
+)
+parser.add_argument(
+    '--batch',
+    type=argparse.FileType('r'),
+    metavar='FILE',
+    help="Get the responses to many prompts, one per line (or JSON objects with a 'prompt', "
+         "'model', 'instructions'), from a file (or - for stdin). Prints JSON lines, in order.",
+)
+parser.add_argument(
+    '-j',
+    '--jobs',
+    type=int,
+    default=4,
+    help="Max concurrent requests in --batch and --map-reduce modes, default: %(default)s",
+)
+parser.add_argument(
+    '--map-reduce',
+    action='store_true',
+    help="For long piped input: answer the question about each chunk of it (concurrently, see --jobs), "
+         "then combine those answers. Re-running the same command resumes after any failed chunks",
+)
+parser.add_argument(
+    '--chunk-tokens',
+    type=int,
+    default=16_000,
+    help="Approx. size of each chunk of the piped input in --map-reduce mode, default: %(default)s",
+)
+parser.add_argument(
+    '--shell-lines',
+    type=int,
+    default=200,
+    help="Max lines of the output of a !shell command to send (its head and tail), the rest "
+         "can be included with /expand, default: %(default)s",
+)
+parser.add_argument(
+    '--daemon',
+    action='store_true',
+    help="Run in the background, answering questions from ./chatgpt-client.py over the --socket. "
+         "Keeps everything warm (imports, connection, instructions, --file's), for fast scripted calls",
+)
+parser.add_argument(
+    '--socket',
+    type=str,
+    help="Path to the Unix socket of the --daemon, default: ~/.config/chatgpt/daemon.sock",
+    default='~/.config/chatgpt/daemon.sock',
+)
 parser.add_argument(
     '--history',
     type=str,
     help="Path to history file, default ~/.config/chatgpt/history.txt",
     default='~/.config/chatgpt/history.txt',
 )
+parser.add_argument(
+    '--history-size',
+    type=int,
+    default=10_000,
+    help="Max entries to keep in the --history file (deduped), default: %(default)s",
+)
 parser.add_argument(
     '-d',
     '--debug',
     action='store_true',
 )
+parser.add_argument(
+    '--profile',
+    action='store_true',
+    help="Print the cProfile stats of each turn to stderr (and save them to chatgpt-cli.py.prof)",
+)
+parser.add_argument(
+    '--startup-profile',
+    action='store_true',
+    help="Print a breakdown of the startup time (eg imports) and exit",
+)
 parser.add_argument(
         '-l',
         "--level",
@@ -523,135 +3080,157 @@ parser.add_argument(
     nargs=argparse.REMAINDER,
 )
 
-args = parser.parse_args()
-
 # History of all user/assistant messages in this conversation dialog
 messages = []
 
-
-################################################################################
-# TODO put this in a main function
-
-# Init (debug) logging
-    # Running within a debugger?
-args.debug = args.debug or bool(sys.gettrace())
-
-# Logging level and defaults
-args.level = args.level or (args.debug and 'DEBUG') or 'WARNING'
-# Allow for prefix-matching too,
-# eg warn => WARNING, deb => DEBUG, err => ERROR, crit => CRITICAL, etc
-levels = logging.getLevelNamesMapping()
-for level_str in levels:
-    if level_str.startswith(args.level.upper()):
-        args.level = level_str
-level_int = levels.get(args.level, levels['WARNING'])
-logging.basicConfig(filename=__file__ + '.log',
-                    filemode='w',
-                    level=level_int,
-                    format='▼ %(asctime)s %(levelname)-8s %(lineno)4d %(funcName)-20s \n%(message)s'
-                    )
-logging.info('\n')
-
-
-# Initialize colorama
-colorama.init(autoreset=True)
-
-# Init readline completion
-rl.set_completer(completer)
-rl.set_completer_delims(' ;?!*"\'') # NB, avoid . and / to complete file paths
-# menu-complete: Tab cycles through completions
-rl.parse_and_bind(r'TAB:menu-complete')
-
-# TODO
-# Allow shift-enter to make a soft-return/newline, rather than submitting input ?
-# But this doesn't work:
-# rl.parse_and_bind(r'"\\e[13;2u": "\n"')
-
-# This should allow the user to arbitrarily expand long-words from their previous history
-# But, it seems unsupported in the Python readline.
-# But we can tokenize the history and add it to the completer() manually ...
-# rl.parse_and_bind(r'"\e/":dabbrev-expand')
-
-# Init readline history
-args.history = os.path.expanduser(args.history)
-hist_dir = os.path.dirname(args.history)
-os.makedirs(hist_dir, exist_ok=True)
-if not os.path.isfile(args.history):
-    open(args.history, 'a').close()
-rl.read_history_file(args.history)
-
-# Enable bracketed paste mode (allows pasting multi-line content into the prompt)
-os.system(r'printf "\e[?2004h"')
-# Disable bracketed paste mode ? at the end ?
-# os.system(r'printf "\e[?2004l"')
-
-key = os.environ.get('OPENAI_API_KEY')
-# TODO any way to verify it's a usable key (eg with a test request) ? Like verifying the model name? Or the quota/usage
-if not key:
-    try:
-        key = open(args.keyfile).read().rstrip()
-    except:
-        print('\n' + Fore.RED + "Error: Set OPENAI_API_KEY or provide a keyfile" + '\n')
-        parser.print_help()
-        exit(1)
-
-
-# Load any custom instructions
-# TODO factor this out, to make it easier to reload
-if args.instructions:
-    args.instructions = os.path.abspath(os.path.expanduser(args.instructions))
-if not os.path.isfile(args.instructions):
-    args.instructions = None
-else:
-    logging.info(f'Custom instructions:\nfile://' + args.instructions)
-    with open(args.instructions, 'r') as file:
-        instructions = file.read()
-        messages.append({ 'role': 'system', 'content': instructions })
-
-# Prepend (the content of) any file(s) that the question/prompt might reference.
-for file_name in args.file:
-    if args.debug :
-        info = '\n' + 'INFO: File to analyze: ' + Style.BRIGHT + file_name + '\n'
-        print(info, file=sys.stderr)
-    # TODO test the file type, only proceed if it's text/plain
-    
-    with open(file_name, 'r') as file:
-        messages.append({
-            'role': 'system',
-            'content': f"File:{file_name}\n(Make use of it when answering subsequent questions)\nContent:\n\n",
-        })
-        messages.append({ 'role': 'system', 'content': file.read() })
-
-# The goal of interactive mode is to allow for follow-up questions.
-# If a question was given on the CLI, assume no follow-up, unless -i given
-args.interactive = len(args.rest) == 0 or args.interactive
-# Any question/prompt written directly on the CLI
-init_input = ' '.join(args.rest)
-
-logging.debug(pp(vars(args)))
-
-# Check if there is any data (already) piped into stdin, if so delimit it
-if select.select([sys.stdin,],[],[],0.0)[0]:
-    init_input += '\n```\n'
-    init_input += sys.stdin.read()
-    init_input += '\n```\n'
-    print('\n', init_input, '\n')
-    # Interactive mode reads from stdin, so it's not compat with piped input
-    args.interactive = False
-
-
-if not args.interactive:
-    # Just print the response, unformatted, and exit
-    if response := get_response(init_input, key=key, model=args.model):
-        print()
-        render(response)
-
-    sys.exit()
+# Initialized in main()
+args = None
+key = None
+
+
+def main():
+    global args, key, client, response_cache
+
+    args = parser.parse_args()
+    if args.startup_profile:
+        startup_profile()
+        sys.exit()
+
+    # Init (debug) logging
+        # Running within a debugger?
+    args.debug = args.debug or bool(sys.gettrace())
+
+    # Logging level and defaults
+    args.level = args.level or (args.debug and 'DEBUG') or 'WARNING'
+    # Allow for prefix-matching too,
+    # eg warn => WARNING, deb => DEBUG, err => ERROR, crit => CRITICAL, etc
+    levels = logging.getLevelNamesMapping()
+    for level_str in levels:
+        if level_str.startswith(args.level.upper()):
+            args.level = level_str
+    level_int = levels.get(args.level, levels['WARNING'])
+    logging.basicConfig(filename=__file__ + '.log',
+                        filemode='w',
+                        level=level_int,
+                        format='▼ %(asctime)s %(levelname)-8s %(lineno)4d %(funcName)-20s \n%(message)s'
+                        )
+    logging.info('\n')
+
+
+    # Initialize colorama
+    colorama.init(autoreset=True)
+
+    client = Client(
+        timeout=(args.connect_timeout, args.read_timeout),
+        retries=args.retries,
+        # Enough to keep a connection per concurrent request alive
+        pool_size=max(4, args.jobs),
+    )
+    atexit.register(lambda: logging.info(pp(client.summary())))
+    atexit.register(lambda: logging.info(pp(list(stats.turns))))
+
+    if args.cache:
+        response_cache = ResponseCache(
+            os.path.expanduser(args.cache_dir),
+            size=args.cache_size * 1e6,
+            ttl=args.cache_ttl * 24 * 60 * 60,
+        )
+        atexit.register(lambda: logging.info(pp(response_cache.summary())))
+
+    args.db = os.path.expanduser(args.db)
+
+    key = os.environ.get('OPENAI_API_KEY')
+    # TODO any way to verify it's a usable key (eg with a test request) ? Like verifying the model name? Or the quota/usage
+    if not key:
+        try:
+            key = open(args.keyfile).read().rstrip()
+        except:
+            print('\n' + Fore.RED + "Error: Set OPENAI_API_KEY or provide a keyfile" + '\n')
+            parser.print_help()
+            exit(1)
+
+
+    # Load any custom instructions
+    # TODO factor this out, to make it easier to reload
+    if args.instructions:
+        args.instructions = os.path.abspath(os.path.expanduser(args.instructions))
+    if not os.path.isfile(args.instructions):
+        args.instructions = None
+    else:
+        logging.info(f'Custom instructions:\nfile://' + args.instructions)
+        with open(args.instructions, 'r') as file:
+            instructions = file.read()
+            messages.append({ 'role': 'system', 'content': instructions })
+
+    # The goal of interactive mode is to allow for follow-up questions.
+    # If a question was given on the CLI, assume no follow-up, unless -i given
+    args.interactive = len(args.rest) == 0 or args.interactive
+    # Any question/prompt written directly on the CLI
+    init_input = ' '.join(args.rest)
+
+    logging.debug(pp(vars(args)))
+
+    # Check if there is any data (already) piped into stdin, if so delimit it
+    # (Unless that's the --batch of prompts, or a --daemon, that gets its questions elsewhere)
+    if not args.batch and not args.daemon and select.select([sys.stdin,],[],[],0.0)[0]:
+        # Unless it's to be read in chunks, by --map-reduce
+        if not args.map_reduce:
+            init_input += '\n```\n'
+            init_input += sys.stdin.read()
+            init_input += '\n```\n'
+            print('\n', init_input, '\n')
+        # Interactive mode reads from stdin, so it's not compat with piped input
+        args.interactive = False
+
+    # Prepend (the content of) any file(s) that the question/prompt might reference.
+    for spec in args.file:
+        if args.debug :
+            info = '\n' + 'INFO: File to analyze: ' + Style.BRIGHT + spec + '\n'
+            print(info, file=sys.stderr)
+        # The question, if any, selects the relevant chunks of a big file
+        attach_file(**parse_file_spec(spec), query=init_input)
+
+
+    if args.batch:
+        batch(args.batch, jobs=args.jobs)
+        sys.exit()
+
+    if args.map_reduce:
+        if sys.stdin.isatty():
+            parser.error('--map-reduce needs piped input')
+        map_reduce(sys.stdin, init_input, jobs=args.jobs)
+        if args.store:
+            conversation_store().sync(messages[int(bool(args.instructions)):], model=args.model)
+        sys.exit()
+
+    if args.daemon:
+        serve(os.path.expanduser(args.socket))
+        sys.exit()
+
+    if not args.interactive:
+        # Just print the response, unformatted, and exit
+        turn = None if args.compare else stats.new(args.model)
+        with profiled():
+            if args.compare:
+                compare(init_input, args.compare)
+            elif args.stream:
+                print()
+                render_stream(get_response_stream(init_input, key=key, model=args.model, turn=turn), turn)
+            elif response := get_response(init_input, key=key, model=args.model, turn=turn):
+                print()
+                with timer(turn, 'render'):
+                    render(response)
+
+        if args.store:
+            conversation_store().sync(messages[int(bool(args.instructions)):], model=args.model)
+
+        sys.exit()
+
+    interactive(init_input)
 
 
 ################################################################################
 # Interactive mode:
-# TODO factor this out
 
 # NB, I tried to keep interactive mode in the case of piped input, but I failed.
 # Since the piped input is on stdin, once it's consumed, it's stuck in EOF, it seems.
@@ -663,165 +3242,298 @@ if not args.interactive:
 # And how to make Shift-Enter or Alt-Enter insert a newline, rather than ending the input() ?
 # And how to make Ctrl-Enter send the message, rather than ending the input() ?
 
-# Set terminal default title (until we determine a topical title)
-set_terminal_title()
-title = None
-
-# Clear/scroll screen
-# print('\033c')
-print()
-
-# (User) message counter width
-DIGITS = 2
-
-while True:
-
-    # Counts the number of user messages (since they always alternate?)
-    i = len(messages) // 2 + 1
-    prompt_items = [ *[]
-        , '▼ #'
-        # , ' ' * min(2,INDENT-DIGITS-1)
-        , f'{i:{DIGITS}d}'
-        # , '\n'
-    ]
-    prompt = ''.join(prompt_items)
-    if init_input:
-        user_input = init_input
-        init_input = None
-    else:
-        user_input = None
-    if user_input:
-        print(Style.DIM + prompt)
-        print(user_input)
 
-    while not user_input:
-        try:
-            # NB, no non-printing chars/formatting codes in the input prompt.
-            # Else readline miscalculates line length, which breaks editing.
+def interactive(init_input: str) -> None:
+    global title_worker, history_file
+
+    # Terminal setup, only needed for interactive mode
+
+    # Init readline completion
+    rl.set_completer(completer)
+    rl.set_completer_delims(' ;?!*"\'') # NB, avoid . and / to complete file paths
+    # menu-complete: Tab cycles through completions
+    rl.parse_and_bind(r'TAB:menu-complete')
+    # File names are likely to be completed near the --file's
+    if args.file:
+        dir_cache.prescan([ os.path.dirname(parse_file_spec(spec)['file_name']) or '.' for spec in args.file ])
+
+    # TODO
+    # Allow shift-enter to make a soft-return/newline, rather than submitting input ?
+    # But this doesn't work:
+    # rl.parse_and_bind(r'"\\e[13;2u": "\n"')
+
+    # This should allow the user to arbitrarily expand long-words from their previous history
+    # But, it seems unsupported in the Python readline.
+    # But we can tokenize the history and add it to the completer() manually ...
+    # rl.parse_and_bind(r'"\e/":dabbrev-expand')
+
+    # Init readline history (the most recent part of it)
+    history_file = HistoryFile(os.path.expanduser(args.history), size=args.history_size)
+    history_file.load()
+
+    # Enable bracketed paste mode (allows pasting multi-line content into the prompt)
+    # (Unless the output isn't a terminal)
+    if sys.stdout.isatty():
+        os.system(r'printf "\e[?2004h"')
+    # Disable bracketed paste mode ? at the end ?
+    # os.system(r'printf "\e[?2004l"')
+
+    # Set terminal default title (until we determine a topical title)
+    set_terminal_title()
+    # Don't let a title arrive after we've exited
+    atexit.register(lambda: title_worker and title_worker.cancel())
+
+    # Clear/scroll screen
+    # print('\033c')
+    print()
+
+    # (User) message counter width
+    DIGITS = 2
+
+    # Prompts typed ahead, while a response was in flight, in order
+    queued = collections.deque()
+
+    while True:
+
+        if args.store:
+            # Save the messages (so far), but not the instructions
+            conversation_store().sync(
+                messages[int(bool(args.instructions)):],
+                model=args.model,
+                title=title_worker and title_worker.title,
+            )
+
+        finish_shell_jobs()
+
+        # Counts the number of user messages (since they always alternate?)
+        i = len(messages) // 2 + 1
+        prompt_items = [ *[]
+            , '▼ #'
+            # , ' ' * min(2,INDENT-DIGITS-1)
+            , f'{i:{DIGITS}d}'
+            # , '\n'
+        ]
+        prompt = ''.join(prompt_items)
+        if init_input:
+            user_input = init_input
+            init_input = None
+        elif queued:
+            user_input = queued.popleft()
+            # As if it had been entered at this prompt
+            rl.add_history(user_input)
+        else:
+            user_input = None
+        if user_input:
             print(Style.DIM + prompt)
-            user_input = input(' ' * INDENT)
-            user_input = user_input.strip()
-        except (KeyboardInterrupt):
-            # Just cancel/reset the current line/prompt
-            print('^C')
-        except (KeyboardInterrupt, EOFError):
-            # Ctrl-D to exit
-            print()
-            sys.exit()
-
-    hist_len = rl.get_current_history_length()
-
-    # TODO refactor this into a dispatch table, with functions for each command
-    # Based on the `commands` dict
-    # Use `match` to match the command name, and grab any args in an optional list
-    # But, also need to decide if we allow more than one command/pattern to match
-    # And if we store history and submit to GPT or not
-    # Eg additional attributes for each command, like 'submit' or 'history' or 'exclusive' ?
-    if False: ...
-    elif match := regex.match(r'^\/model\s*([a-z0-9.-]+)?\s*$', user_input):
-        # /meta commands
-        print('models: ',   commands['model']['choices'])
-        if match.group(1):
-            if not match.group(1) in commands['model']['choices']:
+            print(user_input)
+
+        while not user_input:
+            try:
+                # NB, no non-printing chars/formatting codes in the input prompt.
+                # Else readline miscalculates line length, which breaks editing.
+                print(Style.DIM + prompt)
+                user_input = input(' ' * INDENT)
+                user_input = user_input.strip()
+            except (KeyboardInterrupt):
+                # Just cancel/reset the current line/prompt
+                print('^C')
+            except (KeyboardInterrupt, EOFError):
+                # Ctrl-D to exit
+                print()
+                sys.exit()
+
+        hist_len = rl.get_current_history_length()
+        # Models to ask concurrently, if any
+        compare_models = None
+
+        # TODO refactor this into a dispatch table, with functions for each command
+        # Based on the `commands` dict
+        # Use `match` to match the command name, and grab any args in an optional list
+        # But, also need to decide if we allow more than one command/pattern to match
+        # And if we store history and submit to GPT or not
+        # Eg additional attributes for each command, like 'submit' or 'history' or 'exclusive' ?
+        if False: ...
+        elif match := re.match(r'^\/model\s*([a-z0-9.-]+)?\s*$', user_input):
+            # /meta commands
+            print('models: ',   commands['model']['choices'])
+            if match.group(1):
+                if not match.group(1) in commands['model']['choices']:
+                    continue
+                args.model = match.group(1)
+            print(Fore.LIGHTBLACK_EX + f"model={args.model}")
+            user_input = None
+        elif match := re.match(r'^\/compare\s+([a-z0-9.,-]+)\s*(.*?)\s*$', user_input, re.DOTALL):
+            compare_models = match.group(1).split(',')
+            # Else the previous question
+            user_input = match.group(2)
+        elif match := re.match(r'^\/file\s*(\S*)\s*(.*?)\s*$', user_input):
+            if match.group(1):
+                # Else the chunks relevant to the previous question
+                query = match.group(2) or next((m['content'] for m in reversed(messages) if m['role'] == 'user'), None)
+                attach_file(**parse_file_spec(os.path.expanduser(match.group(1))), query=query)
+            list_attachments()
+            continue
+        elif match := re.match(r'^\/edit\s*(.*)\s*$', user_input):
+            print(f'Editing ... ', end='', flush=True)
+            if match.group(1):
+                edit_content = match.group(1)
+            else:
+                # Get the prev input, before this /edit command
+                edit_content = rl.get_history_item(hist_len-1)
+                # TODO but then do we want to replace this msg in `messages` ?
+            user_input = editor(edit_content)
+            # TODO print with rich ?
+            print(Style.DIM + '\r\n' + user_input)
+            if input(Style.BRIGHT + "Submit? (Y/n): ").casefold() == 'n':
+                # Remove the answer to the input() question
+                rl.remove_history_item(hist_len)
                 continue
-            args.model = match.group(1)
-        print(Fore.LIGHTBLACK_EX + f"model={args.model}")
-        user_input = None
-    elif match := regex.match(r'^\/file\s*(.*?)\s*$', user_input):
-        # TODO list existing files, else upload new one
-        print("# TODO")
-    elif match := regex.match(r'^\/edit\s*(.*)\s*$', user_input):
-        print(f'Editing ... ', end='', flush=True)
-        if match.group(1):
-            edit_content = match.group(1)
-        else:
-            # Get the prev input, before this /edit command
-            edit_content = rl.get_history_item(hist_len-1)
-            # TODO but then do we want to replace this msg in `messages` ?
-        user_input = editor(edit_content)
-        # TODO print with rich ?
-        print(Style.DIM + '\r\n' + user_input)
-        if input(Style.BRIGHT + "Submit? (Y/n): ").casefold() == 'n':
-            # Remove the answer to the input() question
-            rl.remove_history_item(hist_len)
+            rl.add_history(user_input)
+        elif match := re.match(r'^\/reload\s*$', user_input):
+            # Reload this script/source (for latest changes)
+            # And show the last modification time of this file
+            tl = time.localtime(os.path.getmtime(sys.argv[0]))[0:6]
+            ts = "%04d-%02d-%02d %02d:%02d:%02d" % tl
+            logging.debug(f"{os.getpid()=} mtime={ts} {sys.argv[0]=}")
+            # Since exec skips the atexit handlers
+            remove_shell_outputs()
+            os.execv(sys.argv[0], sys.argv)
+        elif match := re.match(r'^\/revert\s*$', user_input):
+            prev = rl.get_history_item(hist_len-1)
+            rl.remove_history_item(hist_len-1) # Remove the /revert command
+            rl.remove_history_item(hist_len-2) # Remove the prev user Q
+            print(Style.DIM + '\r\n' + 'Removed: ' + prev)
+            # TODO verify that these correspond
+            if messages: messages.pop() # Remove the assistant response
+            if messages: messages.pop() # Remove the user prompt
+            user_input = None
+        elif match := re.match(r'^\/(messages|msgs)\s*$', user_input):
+            # Dump all the messages
+            for i, msg in enumerate(messages):
+                print(Style.DIM + f"#{i:2d} {msg['role']:10s}:")
+                print(wrapper(msg['content']) + "\n")
+            continue
+        elif match := re.match(r'^\/(copy|cp)\s*$', user_input):
+            # Copy the last assistant response to the clipboard
+            msgs = [ m for m in messages if m['role'] == 'assistant' ]
+            if msgs:
+                copy_to_clipboard(msgs[-1]['content'])
+                print(Style.DIM + 'Copied to clipboard')
+            continue
+        elif match := re.match(r'^\/clear\s*$', user_input):
+            # Clear the conversation history
+            # But, keep the instructions, if any were given
+            del messages[int(bool(args.instructions)):]
+            # clear terminal, and move cursor to bottom
+            os.system('clear; tput cup "$(tput lines)"')
+            if title_worker:
+                title_worker.cancel()
+                title_worker = None
+            set_terminal_title()
+            if args.store:
+                conversation_store().new()
+            continue
+        elif match := re.match(r'^\/history\s*(.*?)\s*$', user_input):
+            if not args.store:
+                print(Fore.YELLOW + 'Conversations are not stored (--no-store)')
+            elif not match.group(1):
+                print_threads(conversation_store().recent())
+            elif match.group(1).isdigit():
+                # Resume that thread, replacing the current one, after the instructions
+                title, msgs = conversation_store().resume(int(match.group(1)))
+                if not msgs:
+                    print(Fore.RED + f'No such conversation: {match.group(1)}')
+                    continue
+                del messages[int(bool(args.instructions)):]
+                messages.extend(msgs)
+                if title_worker:
+                    title_worker.cancel()
+                    title_worker = None
+                set_terminal_title(title)
+                print(Style.DIM + f'Resumed: {title} ({len(msgs)} messages)')
+            else:
+                print_threads(conversation_store().search(match.group(1)))
+            continue
+        elif match := re.match(r'^\/usage\s*$', user_input):
+            usage()
+            continue
+        elif match := re.match(r'^\/regenerate\s*(\d+)?\s*$', user_input):
+            if response := regenerate(int(match.group(1) or 100) / 100):
+                completion_index.ingest(response)
+            continue
+        elif match := re.match(r'^\/stats\s*$', user_input):
+            stats.report()
+            continue
+        elif match := re.match(r'^\/expand\s*(\d+)\s*$', user_input):
+            expand_shell_output(int(match.group(1)))
+            continue
+        elif match := re.match(r'^\/jobs\s*$', user_input):
+            list_shell_jobs()
+            continue
+        elif match := re.match(r'^[?/]', user_input):
+            print("/commands:")
+            for cmd in sorted(commands.keys()):
+                print(f"/{cmd:10s}{commands[cmd]['desc']}")
+            continue
+        elif match := re.match(r'^\s*[!$]\s*(.*?)\s*&\s*$', user_input):
+            # Keep chatting, while it runs
+            shell_job(match.group(1))
             continue
-        rl.add_history(user_input)
-    elif match := regex.match(r'^\/reload\s*$', user_input):
-        # Reload this script/source (for latest changes)
-        # And show the last modification time of this file
-        tl = time.localtime(os.path.getmtime(sys.argv[0]))[0:6]
-        ts = "%04d-%02d-%02d %02d:%02d:%02d" % tl
-        logging.debug(f"{os.getpid()=} mtime={ts} {sys.argv[0]=}")
-        os.execv(sys.argv[0], sys.argv)
-    elif match := regex.match(r'^\/revert\s*$', user_input):
-        prev = rl.get_history_item(hist_len-1)
-        rl.remove_history_item(hist_len-1) # Remove the /revert command
-        rl.remove_history_item(hist_len-2) # Remove the prev user Q
-        print(Style.DIM + '\r\n' + 'Removed: ' + prev)
-        # TODO verify that these correspond
-        if messages: messages.pop() # Remove the assistant response
-        if messages: messages.pop() # Remove the user prompt
+        elif match := re.match(r'^\s*[!$]\s*(.*)', user_input):
+            output = ShellOutput(match.group(1), lines=args.shell_lines)
+            run_shell(output)
+            if stdout := ''.join(output.stdout).strip():
+                copy_to_clipboard(stdout)
+            add_shell_output(output)
+            continue
+
+
+        # Do this in every iteration, since we could abort any time
+        history_file.save()
+
+        if user_input and args.compare:
+            compare_models = args.compare
+        if user_input or compare_models:
+            print('... ', end='')
+            # (Each of the compared models records its own)
+            turn = None if compare_models else stats.new(args.model)
+            with profiled():
+                if compare_models:
+                    # Not typed ahead, since it then asks which answer to keep
+                    response = compare(user_input, compare_models)
+                elif args.stream:
+                    with TypeAhead(queued):
+                        hr()
+                        response = render_stream(get_response_stream(user_input, key=key, model=args.model, turn=turn), turn)
+                    if not response and messages and messages[-1]['role'] == 'user':
+                        # Aborted (Ctrl-C) before any answer: as if not asked
+                        messages.pop()
+                else:
+                    with TypeAhead(queued):
+                        try:
+                            response = get_response(user_input, key=key, model=args.model, turn=turn)
+                        except KeyboardInterrupt:
+                            # Abort (only) this request, and its question, but not any queued ones
+                            print('^C')
+                            if messages and messages[-1]['role'] == 'user':
+                                messages.pop()
+                            response = None
+                    if response:
+                        hr()
+                        with timer(turn, 'render'):
+                            render(response)
+
+            if response:
+                completion_index.ingest(response)
+                if title_worker and title_worker.title is None and not title_worker.is_alive():
+                    # It failed (eg a timeout), so try again, with this turn too
+                    title_worker = None
+                if not title_worker:
+                    title_worker = TitleWorker(messages, turn)
+                    title_worker.start()
+
         user_input = None
-    elif match := regex.match(r'^\/(messages|msgs)\s*$', user_input):
-        # Dump all the messages
-        for i, msg in enumerate(messages):
-            print(Style.DIM + f"#{i:2d} {msg['role']:10s}:")
-            print(wrapper(msg['content']) + "\n")
-        continue
-    elif match := regex.match(r'^\/(copy|cp)\s*$', user_input):
-        # Copy the last assistant response to the clipboard
-        msgs = [ m for m in messages if m['role'] == 'assistant' ]
-        if msgs:
-            pyperclip.copy(msgs[-1]['content'])
-            print(Style.DIM + 'Copied to clipboard')
-        continue
-    elif match := regex.match(r'^\/clear\s*$', user_input):
-        # Clear the conversation history
-        # But, keep the instructions, if any were given
-        del messages[int(bool(args.instructions)):]
-        # clear terminal, and move cursor to bottom
-        os.system('clear; tput cup "$(tput lines)"')
-        title = None
-        set_terminal_title()
-        continue
-    elif match := regex.match(r'^\/usage\s*$', user_input):
-        usage()
-        continue
-    elif match := regex.match(r'^[?/]', user_input):
-        print("/commands:")
-        for cmd in sorted(commands.keys()):
-            print(f"/{cmd:10s}{commands[cmd]['desc']}")
-        continue
-    elif match := regex.match(r'^\s*[!$]\s*(.*)', user_input):
-        cmd = match.group(1)
-        # Allow running (bash) functions/aliases
-        # TODO doc the '$' wrapper, maybe add it as an example to the repo ?
-        source = f'$ {cmd}'
-        out = subprocess.run(source, shell=True, text=True, capture_output=True)
-        if out.stdout:
-            out.stdout = out.stdout.strip()
-            print(out.stdout)
-            pyperclip.copy(out.stdout)
-        if out.stderr:
-            print(Fore.RED + out.stderr, end='')
-
-        messages.append( { 'role': 'user',   'content': '$ ' + cmd } )
-        messages.append( { 'role': 'system', 'content': out.stdout + '\n' + out.stderr } )
-        continue
-
-
-    # Do this in every iteration, since we could abort any time
-    rl.write_history_file(args.history)
-
-    if user_input:
-        print('... ', end='')
-        # TODO allow this to be Ctrl-C interrupted (if we do streaming ...)
-        if response := get_response(user_input, key=key, model=args.model):
-            hr()
-            render(response)
 
-            if not title:
-                title = get_chat_topic()
-                set_terminal_title(title)
 
-    user_input = None
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+# A minimal client of a resident `chatgpt-cli.py --daemon`, for fast one-shot/scripted questions.
+# Only (light) stdlib imports, so the local overhead is little more than starting the interpreter.
+# If no daemon is running, it just runs chatgpt-cli.py instead.
+#
+# $ ./chatgpt-cli.py --daemon &
+# $ ./chatgpt-client.py "some question"
+# $ git diff | ./chatgpt-client.py "Review this"
+
+import argparse
+import json
+import os
+import select
+import socket
+import sys
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--socket',
+    type=str,
+    help="Path to the Unix socket of the daemon, default: ~/.config/chatgpt/daemon.sock",
+    default='~/.config/chatgpt/daemon.sock',
+)
+parser.add_argument('-m', '--model', type=str, help="OpenAI model to target, default: that of the daemon")
+parser.add_argument('--complete', type=str, metavar='PREFIX', help="Print the tab-completions of the prefix")
+parser.add_argument('rest', nargs=argparse.REMAINDER)
+
+
+def main():
+    args = parser.parse_args()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(os.path.expanduser(args.socket))
+    except (FileNotFoundError, ConnectionRefusedError):
+        if args.complete is not None:
+            # Completions are of the daemon's conversations, so none without it
+            sys.exit(1)
+        # No daemon, so no warm state, but still an answer
+        cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chatgpt-cli.py')
+        model = [ '--model', args.model ] if args.model else []
+        os.execv(sys.executable, [ sys.executable, cli, *model, *args.rest ])
+
+    if args.complete is not None:
+        request = { 'complete': args.complete }
+    else:
+        prompt = ' '.join(args.rest)
+        # Any data piped into stdin, delimited, like chatgpt-cli.py does
+        if select.select([ sys.stdin ], [], [], 0.0)[0]:
+            prompt += '\n```\n' + sys.stdin.read() + '\n```\n'
+        request = { 'prompt': prompt, 'model': args.model }
+    sock.sendall(json.dumps(request).encode() + b'\n')
+
+    # Raw bytes, since a UTF-8 char could be split across reads
+    out = sys.stdout.buffer
+    try:
+        while data := sock.recv(4096):
+            out.write(data)
+            out.flush()
+        out.write(b'\n')
+    except (KeyboardInterrupt, BrokenPipeError):
+        # Closing the socket aborts the request in the daemon
+        pass
+    finally:
+        sock.close()
+
+
+if __name__ == '__main__':
+    main()
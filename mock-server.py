@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+# A local mock of the OpenAI chat completions API, for testing and benchmarking offline.
+# Imitates (streamed) chat completions, with injected latency, rate limits (429), large payloads,
+# and prompt caching. And the Responses API, with stored (and expiring) server-side conversations.
+#
+# $ ./mock-server.py --port 8080 --latency 0.2
+# $ ./chatgpt-cli.py --base-url http://127.0.0.1:8080/v1 "some question"
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+WORDS = (
+    'the of and to in is that for it as with was on be by this are from or an which '
+    'response completion conversation terminal readline markdown streaming latency '
+    'connection benchmark performance throughput context tokens history'
+).split()
+
+
+def completion(msgs: list, words: int, variant: int = 0) -> str:
+    """A Markdown response (deterministic, for a given question and variant) of about `words` words"""
+    question = next((m['content'] for m in reversed(msgs) if m['role'] == 'user'), '')
+    rand = random.Random(f'{question}#{variant}' if variant else question)
+    paras = []
+    while words > 0:
+        n = min(words, rand.randint(20, 80))
+        paras.append(' '.join(rand.choice(WORDS) for _ in range(n)).capitalize() + '.')
+        words -= n
+    code = '```python\nprint("Hello, World!")\n```'
+    # Echo (the start of) the question, to make it recognizable
+    return f'**{question[:60].strip()}**\n\n' + '\n\n'.join(paras[:1] + [ code ] + paras[1:])
+
+
+def usage(msgs: list, content: str, cached: int = 0) -> dict:
+    prompt_tokens = sum(len(m['content']) for m in msgs) // 4
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': len(content) // 4,
+        'total_tokens': prompt_tokens + len(content) // 4,
+        'prompt_tokens_details': { 'cached_tokens': cached },
+    }
+
+
+def response_usage(msgs: list, content: str, cached: int = 0) -> dict:
+    """The usage, as named by the Responses API"""
+    chat = usage(msgs, content, cached)
+    return {
+        'input_tokens': chat['prompt_tokens'],
+        'output_tokens': chat['completion_tokens'],
+        'total_tokens': chat['total_tokens'],
+        'input_tokens_details': { 'cached_tokens': cached },
+    }
+
+
+def cached_tokens(server, msgs: list) -> int:
+    """Imitate prompt caching: the tokens of the longest prefix (of whole messages) seen before
+
+    Like the API, only for prompts of 1024+ tokens, and in increments of 128 tokens.
+    """
+    prefixes = []
+    for msg in msgs:
+        # A hash of the prefix, up to this message
+        prefixes.append(hash((prefixes[-1] if prefixes else 0, json.dumps(msg))))
+    with server.lock:
+        seen = max((i for i, h in enumerate(prefixes, 1) if h in server.prefixes), default=0)
+        server.prefixes.update(prefixes)
+    tokens = sum(len(m['content']) for m in msgs[:seen]) // 4
+    return tokens // 128 * 128 if tokens >= 1024 else 0
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Allow keep-alive
+    protocol_version = 'HTTP/1.1'
+    # Else the headers and body, written separately, wait on delayed ACKs (~40ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        if self.server.args.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status: int, obj: dict, headers: dict = {}) -> None:
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunk(self, string: str) -> None:
+        data = string.encode()
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def send_event(self, obj: dict) -> None:
+        """An event of a streamed response of the Responses API"""
+        self.send_chunk(f"event: {obj['type']}\ndata: {json.dumps(obj)}\n\n")
+
+    def previous(self, data: dict) -> Optional[list]:
+        """The stored conversation up to the `previous_response_id`, if any, else None if expired"""
+        if not (id := data.get('previous_response_id')):
+            return []
+        with self.server.lock:
+            created, msgs = self.server.responses.get(id, (0, None))
+        if msgs is None or time.time() - created > self.server.args.expire:
+            return None
+        return msgs
+
+    def do_POST(self):
+        args = self.server.args
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        data = json.loads(body or '{}')
+        path = self.path.rstrip('/')
+        if not path.endswith(('/chat/completions', '/responses')):
+            self.send_json(404, { 'error': { 'message': f'Unknown path: {self.path}' } })
+            return
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.received += len(body)
+        if path.endswith('/responses'):
+            if (msgs := self.previous(data)) is None:
+                self.send_json(400, { 'error': {
+                    'message': f"Previous response with id '{data['previous_response_id']}' not found.",
+                    'type': 'invalid_request_error',
+                    'param': 'previous_response_id',
+                    'code': 'previous_response_not_found',
+                } })
+                return
+            input = data.get('input', [])
+            msgs = msgs + ([ { 'role': 'user', 'content': input } ] if isinstance(input, str) else input)
+        else:
+            msgs = data.get('messages', [])
+        cached = cached_tokens(self.server, msgs)
+        # A cached prompt is processed faster
+        prompt_tokens = sum(len(m['content']) for m in msgs) // 4
+        time.sleep(args.latency * (1 - .5 * cached / max(1, prompt_tokens)))
+        if random.random() < args.error_rate:
+            self.send_json(
+                429,
+                { 'error': { 'message': 'Rate limit reached (mock)', 'type': 'rate_limit' } },
+                { 'Retry-After': str(args.retry_after) },
+            )
+            return
+
+        if path.endswith('/responses'):
+            self.respond(data, msgs, cached)
+            return
+
+        # Different choices, unless at temperature 0
+        choices = [
+            completion(msgs, args.words, i + 1 if data.get('temperature') else 0) for i in range(data.get('n', 1))
+        ]
+        if not data.get('stream'):
+            self.send_json(200, {
+                'id': f'chatcmpl-mock-{self.server.requests}',
+                'object': 'chat.completion',
+                'model': data.get('model'),
+                'choices': [
+                    { 'index': i, 'message': { 'role': 'assistant', 'content': c }, 'finish_reason': 'stop' }
+                    for i, c in enumerate(choices)
+                ],
+                'usage': usage(msgs, ''.join(choices), cached),
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        content = choices[0]
+        # A few words per delta, like tokens
+        deltas = [ content[i:i + 16] for i in range(0, len(content), 16) ]
+        for delta in deltas:
+            chunk = { 'choices': [ { 'index': 0, 'delta': { 'content': delta } } ] }
+            self.send_chunk('data: ' + json.dumps(chunk) + '\n\n')
+            time.sleep(args.delay)
+        if data.get('stream_options', {}).get('include_usage'):
+            self.send_chunk('data: ' + json.dumps({ 'choices': [], 'usage': usage(msgs, content, cached) }) + '\n\n')
+        self.send_chunk('data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def respond(self, data: dict, msgs: list, cached: int) -> None:
+        """A (streamed) response of the Responses API, stored (with its conversation) by its id"""
+        content = completion(msgs, self.server.args.words)
+        with self.server.lock:
+            id = f'resp_mock_{self.server.requests}'
+            if data.get('store', True):
+                self.server.responses[id] = (time.time(), msgs + [ { 'role': 'assistant', 'content': content } ])
+        response = {
+            'id': id,
+            'object': 'response',
+            'status': 'completed',
+            'model': data.get('model'),
+            'previous_response_id': data.get('previous_response_id'),
+            'error': None,
+            'output': [ {
+                'type': 'message',
+                'id': f'msg_mock_{self.server.requests}',
+                'role': 'assistant',
+                'status': 'completed',
+                'content': [ { 'type': 'output_text', 'text': content, 'annotations': [] } ],
+            } ],
+            'usage': response_usage(msgs, content, cached),
+        }
+        if not data.get('stream'):
+            self.send_json(200, response)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.send_event({ 'type': 'response.created', 'response': { **response, 'status': 'in_progress', 'output': [] } })
+        for i in range(0, len(content), 16):
+            self.send_event({ 'type': 'response.output_text.delta', 'output_index': 0, 'delta': content[i:i + 16] })
+            time.sleep(self.server.args.delay)
+        self.send_event({ 'type': 'response.completed', 'response': response })
+        self.wfile.write(b'0\r\n\r\n')
+
+
+def serve(args) -> ThreadingHTTPServer:
+    """Start the server (in a background thread), eg from a benchmark"""
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    server.args = args
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.received = 0
+    # For imitating prompt caching
+    server.prefixes = set()
+    # Stored (server-side) conversations of the Responses API, by response id
+    server.responses = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('-p', '--port', type=int, default=8080, help="0 for any free port")
+parser.add_argument('--latency', type=float, default=0.0, help="Seconds before each response")
+parser.add_argument('--delay', type=float, default=0.0, help="Seconds between streamed deltas")
+parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests to fail with 429")
+parser.add_argument('--retry-after', type=float, default=1, help="Retry-After of 429s, in seconds")
+parser.add_argument('--expire', type=float, default=30 * 24 * 3600, help="Seconds to store each response (Responses API)")
+parser.add_argument('--words', type=int, default=200, help="Size of each response, in words")
+parser.add_argument('-v', '--verbose', action='store_true')
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    server = serve(args)
+    print(f'Listening on http://{args.host}:{server.server_address[1]}/v1')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()